@@ -0,0 +1,519 @@
+#!/bin/python
+
+# Measures the import pipeline on synthetic AAF files, outside REAPER.
+# Essence extraction, timeline parsing and project building are timed
+# separately, build_project runs against MockReaper instead of ReaScript.
+#
+#   python benchmark.py --masters 50 --tracks 32 --clips 500 --json result.json
+#   python benchmark.py --compare result.json
+
+import aaf2
+import os
+import sys
+import math
+import struct
+import time
+import json
+import argparse
+import tempfile
+import shutil
+import uuid
+import tracemalloc
+
+import importaaf
+
+
+# Stands in for the RPR_* functions of REAPER's Python API.
+# Every call is counted, objects are plain integer handles. Track names,
+# items, envelope points, extension data and markers are kept for
+# re-conforming.
+class MockReaper:
+
+    def __init__(self):
+        self.calls = {}
+        self.tracks = []
+        self.track_info = {}
+        self.selected_track = None
+        self.envelopes = {}
+        self.envelope_points = {}
+        self.items = {}
+        self.item_data = {}
+        self.markers = []
+        self.handles = 0
+        self.chunk_bytes = 0
+
+    def install(self, module):
+        for name in dir(self):
+            if name.startswith("RPR_"):
+                setattr(module, name, self.count(name, getattr(self, name)))
+
+    def count(self, name, function):
+        def call(*args):
+            self.calls[name] = self.calls.get(name, 0) + 1
+            return function(*args)
+        return call
+
+    def get_call_count(self):
+        return sum(self.calls.values())
+
+    def new_handle(self):
+        self.handles += 1
+        return self.handles
+
+    def RPR_GetUserFileNameForRead(self, filename, title, extension):
+        return False, filename, title, extension
+
+    def RPR_GetProjectPath(self, buffer, size):
+        return tempfile.gettempdir(), size
+
+    def RPR_ShowConsoleMsg(self, message):
+        pass
+
+    def RPR_MB(self, message, title, buttons):
+        return 6
+
+    def RPR_GetNumTracks(self):
+        return len(self.tracks)
+
+    def RPR_InsertTrackAtIndex(self, index, defaults):
+        self.tracks.insert(index, self.new_handle())
+
+    def RPR_GetTrack(self, project, index):
+        return self.tracks[index]
+
+    def RPR_GetSetMediaTrackInfo_String(self, track, name, value, set_value):
+        if set_value:
+            self.track_info[(track, name)] = value
+        return True, track, name, self.track_info.get((track, name), ""), set_value
+
+    def RPR_SetMediaTrackInfo_Value(self, track, name, value):
+        return True
+
+    def RPR_SetOnlyTrackSelected(self, track):
+        self.selected_track = track
+
+    # Showing the volume or pan envelope creates it
+    def RPR_Main_OnCommand(self, command, flag):
+        name = {40406: "Volume", 40407: "Pan"}.get(command, None)
+        if name and (self.selected_track, name) not in self.envelopes:
+            self.add_envelope(self.selected_track, name)
+
+    def add_envelope(self, track, name):
+        envelope = self.envelopes[(track, name)] = self.new_handle()
+        self.envelope_points[envelope] = []
+        return envelope
+
+    def RPR_GetTrackEnvelopeByName(self, track, name):
+        return self.envelopes.get((track, name), 0)
+
+    def RPR_ValidatePtr2(self, project, pointer, type_name):
+        return bool(pointer)
+
+    def RPR_ScaleToEnvelopeMode(self, mode, value):
+        return value
+
+    def RPR_InsertEnvelopePoint(self, envelope, time, value, shape, tension, selected, no_sort):
+        self.envelope_points[envelope].append((time, value, shape))
+        return True
+
+    def RPR_Envelope_SortPoints(self, envelope):
+        self.envelope_points[envelope].sort(key=lambda point: point[0])
+        return True
+
+    def RPR_CountEnvelopePoints(self, envelope):
+        return len(self.envelope_points[envelope])
+
+    def RPR_GetEnvelopePoint(self, envelope, index, time, value, shape, tension, selected):
+        time, value, shape = self.envelope_points[envelope][index]
+        return True, envelope, index, time, value, shape, 0.0, False
+
+    def RPR_DeleteEnvelopePointRange(self, envelope, start, end):
+        self.envelope_points[envelope] = [point for point in self.envelope_points[envelope]
+            if not start <= point[0] < end]
+        return True
+
+    def RPR_PCM_Source_CreateFromFile(self, filename):
+        return self.new_handle()
+
+    def RPR_AddMediaItemToTrack(self, track):
+        item = self.new_handle()
+        self.items.setdefault(track, []).append(item)
+        return item
+
+    def RPR_CountTrackMediaItems(self, track):
+        return len(self.items.get(track, []))
+
+    def RPR_GetTrackMediaItem(self, track, index):
+        return self.items[track][index]
+
+    def RPR_DeleteTrackMediaItem(self, track, item):
+        self.items[track].remove(item)
+        return True
+
+    def RPR_GetSetMediaItemInfo_String(self, item, name, value, set_value):
+        if set_value:
+            self.item_data[item] = value
+        return True, item, name, self.item_data.get(item, ""), set_value
+
+    def RPR_GetActiveTake(self, item):
+        return item
+
+    def RPR_AddTakeToMediaItem(self, item):
+        return self.new_handle()
+
+    def RPR_SetMediaItemTake_Source(self, take, source):
+        return True
+
+    def RPR_GetSetMediaItemTakeInfo_String(self, take, name, value, set_value):
+        return True, take, name, value, set_value
+
+    def RPR_SetMediaItemInfo_Value(self, item, name, value):
+        return True
+
+    def RPR_SetMediaItemTakeInfo_Value(self, take, name, value):
+        return True
+
+    def RPR_ColorToNative(self, r, g, b):
+        return r | g << 8 | b << 16
+
+    def RPR_AddProjectMarker2(self, project, region, position, end, name, index, colour):
+        self.markers.append((position, name))
+        return len(self.markers)
+
+    def RPR_EnumProjectMarkers(self, index, region, position, end, name, number):
+        if index >= len(self.markers):
+            return 0, index, region, position, end, name, number
+        position, name = self.markers[index]
+        return index + 1, index, False, position, 0.0, name, index + 1
+
+    def RPR_SetTrackStateChunk(self, track, chunk, undo):
+        self.chunk_bytes += len(chunk)
+        self.items[track] = [self.new_handle() for i in range(chunk.count("<ITEM"))]
+        envelope = None
+        for line in chunk.split("\n"):
+            if line in ["<VOLENV2", "<PANENV2"]:
+                envelope = self.add_envelope(track, "Volume" if line == "<VOLENV2" else "Pan")
+            elif envelope and line.startswith("PT "):
+                time, value, shape = line.split()[1:4]
+                self.envelope_points[envelope].append((float(time), float(value), int(shape)))
+            elif line == ">":
+                envelope = None
+        return True
+
+    def RPR_Undo_BeginBlock2(self, project):
+        pass
+
+    def RPR_Undo_EndBlock2(self, project, name, flags):
+        pass
+
+    def RPR_PreventUIRefresh(self, count):
+        pass
+
+    def RPR_TrackList_AdjustWindows(self, minor):
+        pass
+
+    def RPR_UpdateArrange(self):
+        pass
+
+
+# Writes an AAF with embedded 16 bit PCM master clips and one composition.
+# Odd clips sit under a gain OperationGroup with automation, wrapping
+# nesting - 1 more pan groups, every transitions-th cut is a crossfade.
+def generate_aaf(filename, masters=8, seconds=10.0, rate=48000, tracks=8, clips=100,
+        points=50, transitions=4, nesting=2, edit_rate=25):
+    with aaf2.open(filename, "w") as f:
+        def register(definition):
+            f.dictionary.register_def(definition)
+            return definition
+
+        def new_auid():
+            return aaf2.auid.AUID(str(uuid.uuid4()))
+
+        mxf = register(f.create.ContainerDef(new_auid(), "MXF", ""))
+        amplitude = register(f.create.ParameterDef(new_auid(), "Amplitude", "", "Rational"))
+        pan = register(f.create.ParameterDef(new_auid(), "Pan value", "", "Rational"))
+        gain_op = register(f.create.OperationDef(new_auid(), "Mono Audio Gain", ""))
+        pan_op = register(f.create.OperationDef(new_auid(), "Mono Audio Pan", ""))
+        dissolve_op = register(f.create.OperationDef(new_auid(), "Mono Audio Dissolve", ""))
+        for operation in [gain_op, pan_op, dissolve_op]:
+            operation.media_kind = "sound"
+            operation["NumberInputs"].value = 1
+        interpolation = register(f.create.InterpolationDef(aaf2.misc.LinearInterp, "LinearInterp", ""))
+
+        # One second of a tone, repeated for the length of each clip
+        frames = int(seconds * rate)
+        block = b"".join(struct.pack("<h", int(8000 * math.sin(n * 0.05))) for n in range(rate))
+
+        master_slots = []
+        for i in range(masters):
+            master_mob = f.create.MasterMob("clip%d" % i)
+            f.content.mobs.append(master_mob)
+            source_mob = f.create.SourceMob("clip%d.PHYS" % i)
+            f.content.mobs.append(source_mob)
+            essence, source_slot = source_mob.create_essence(rate, "sound")
+            descriptor = f.create.PCMDescriptor()
+            source_mob.descriptor = descriptor
+            descriptor["Channels"].value = 1
+            descriptor["BlockAlign"].value = 2
+            descriptor["SampleRate"].value = rate
+            descriptor["AverageBPS"].value = rate * 2
+            descriptor["QuantizationBits"].value = 16
+            descriptor["AudioSamplingRate"].value = rate
+            descriptor["ContainerFormat"].value = mxf
+            descriptor.length = frames
+            source_slot.segment.length = frames
+            stream = essence.open("w")
+            remaining = frames * 2
+            while remaining > 0:
+                stream.write(block[:remaining])
+                remaining -= len(block)
+            slot = master_mob.create_timeline_slot(edit_rate=rate)
+            slot.segment = source_mob.create_source_clip(source_slot.slot_id, media_kind="sound")
+            slot.name = "A1"
+            master_slots.append((master_mob, slot))
+
+        def new_varying(parameter, count):
+            varying = f.create.VaryingValue()
+            varying.parameterdef = parameter
+            varying.interpolationdef = interpolation
+            for p in range(count):
+                varying.add_keyframe(p / max(count, 1), 0.5 + 0.5 * math.sin(p / 5.0))
+            return varying
+
+        clip_length = max(int(seconds * edit_rate / 4), 2)
+        fade_length = max(clip_length // 4, 1)
+        composition = f.create.CompositionMob("Benchmark")
+        f.content.mobs.append(composition)
+        for t in range(tracks):
+            sequence = f.create.Sequence(media_kind="sound")
+            for c in range(clips):
+                master_mob, slot = master_slots[(t + c) % len(master_slots)]
+                start = (c * 7) % max(int(seconds * edit_rate) - clip_length, 1)
+                component = master_mob.create_source_clip(slot.slot_id, start=start,
+                    length=clip_length, media_kind="sound")
+                if c % 2:
+                    for level in range(nesting):
+                        is_gain = level == nesting - 1
+                        group = f.create.OperationGroup(gain_op if is_gain else pan_op, clip_length, "sound")
+                        group.parameters.append(new_varying(amplitude if is_gain else pan, points))
+                        group.segments.append(component)
+                        component = group
+                sequence.components.append(component)
+                if c == clips - 1: continue
+                if transitions and c % transitions == transitions - 1:
+                    transition = f.create.Transition("sound", fade_length)
+                    transition["OperationGroup"].value = f.create.OperationGroup(dissolve_op, fade_length, "sound")
+                    transition["CutPoint"].value = 0
+                    sequence.components.append(transition)
+                else:
+                    sequence.components.append(f.create.Filler("sound", 5))
+            composition_slot = composition.create_timeline_slot(edit_rate)
+            composition_slot.segment = sequence
+            composition_slot.name = "Track %d" % (t + 1)
+
+
+# Runs one phase, returning its result with wall time and peak memory
+def measure(results, name, action, trace_memory):
+    if trace_memory:
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    value = action()
+    results[name] = {"seconds": time.perf_counter() - start}
+    if trace_memory:
+        results[name]["peak_mb"] = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+    return value
+
+
+def get_size(directory):
+    total = 0
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and name.endswith(".wav"):
+            total += os.path.getsize(path)
+    return total
+
+
+# The timeline with the middle clip of the first track taken out
+# and the clips after it moved up to close the gap.
+def get_edited(composition):
+    edited = json.loads(json.dumps(composition))
+    items = edited["tracks"][0].get("items", [])
+    if items:
+        middle = len(items) // 2
+        removed = items.pop(middle)
+        for item in items[middle:]:
+            item["position"] -= removed["duration"]
+    return edited
+
+
+def run_benchmark(arguments):
+    directory = tempfile.mkdtemp(prefix="importaaf_benchmark_")
+    try:
+        filename = os.path.join(directory, "benchmark.aaf")
+        media = os.path.join(directory, "sources")
+        os.makedirs(media)
+
+        start = time.perf_counter()
+        generate_aaf(filename, arguments.masters, arguments.seconds, arguments.rate, arguments.tracks,
+            arguments.clips, arguments.points, arguments.transitions, arguments.nesting)
+        generated = time.perf_counter() - start
+
+        importaaf.log_level = importaaf.ERROR
+        importaaf.use_essence_cache = False
+        importaaf.extraction_workers = arguments.workers
+        importaaf.parsing_workers = arguments.parse_workers
+        importaaf.consolidate = arguments.consolidate
+
+        if arguments.memory:
+            tracemalloc.start()
+        results = {}
+        try:
+            aaf_interface = importaaf.AAFInterface()
+            measure(results, "open", lambda: aaf_interface.open(filename), arguments.memory)
+            measure(results, "index", aaf_interface.get_index, arguments.memory)
+            measure(results, "extract_essence",
+                lambda: aaf_interface.extract_essence(media, None, 0), arguments.memory)
+            composition = measure(results, "get_composition",
+                lambda: aaf_interface.get_composition(0), arguments.memory)
+
+            items = sum(len(track.get("items", [])) for track in composition["tracks"])
+            envelope_points = sum(len(track.get("volume_envelope", [])) + len(track.get("panning_envelope", []))
+                for track in composition["tracks"])
+
+            for mode, with_chunks in [("build_project_chunks", True), ("build_project_items", False)]:
+                reaper = MockReaper()
+                reaper.install(importaaf)
+                importaaf.build_with_chunks = with_chunks
+                measure(results, mode,
+                    lambda: importaaf.ReaperInterface().build_project(composition), arguments.memory)
+                results[mode]["rpr_calls"] = reaper.get_call_count()
+
+            # Re-conforming the same timeline should leave every item alone,
+            # and an edit should only cost calls for the items it touches.
+            reaper = MockReaper()
+            reaper.install(importaaf)
+            importaaf.build_with_chunks = True
+            importaaf.reconform = True
+            try:
+                for mode, timeline in [("build_project_tagged", composition),
+                        ("reconform_unchanged", composition), ("reconform_edit", get_edited(composition))]:
+                    reaper.calls = {}
+                    measure(results, mode,
+                        lambda: importaaf.ReaperInterface().build_project(timeline), arguments.memory)
+                    results[mode]["rpr_calls"] = reaper.get_call_count()
+            finally:
+                importaaf.reconform = False
+        finally:
+            if arguments.memory:
+                tracemalloc.stop()
+
+        extracted = get_size(media)
+        results["extract_essence"]["mb"] = extracted / (1024 * 1024)
+        results["extract_essence"]["mb_per_second"] = results["extract_essence"]["mb"] / results["extract_essence"]["seconds"]
+        for name in ["get_composition", "build_project_chunks", "build_project_items"]:
+            results[name]["items_per_second"] = items / results[name]["seconds"]
+
+        return {
+            "settings": {
+                "masters": arguments.masters,
+                "seconds": arguments.seconds,
+                "rate": arguments.rate,
+                "tracks": arguments.tracks,
+                "clips": arguments.clips,
+                "points": arguments.points,
+                "transitions": arguments.transitions,
+                "nesting": arguments.nesting,
+                "workers": arguments.workers,
+                "parse_workers": arguments.parse_workers,
+                "consolidate": arguments.consolidate,
+                "numpy": importaaf.have_numpy
+            },
+            "aaf_mb": os.path.getsize(filename) / (1024 * 1024),
+            "generate_seconds": generated,
+            "items": items,
+            "envelope_points": envelope_points,
+            "phases": results
+        }
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def print_report(report, baseline=None):
+    print("%d items, %d envelope points, %.1f MB AAF (generated in %.1f s)" %
+        (report["items"], report["envelope_points"], report["aaf_mb"], report["generate_seconds"]))
+    for name, phase in report["phases"].items():
+        line = "%-22s %9.3f s" % (name, phase["seconds"])
+        if "peak_mb" in phase:
+            line += "  %8.1f MB peak" % phase["peak_mb"]
+        if "mb_per_second" in phase:
+            line += "  %8.1f MB/s" % phase["mb_per_second"]
+        if "items_per_second" in phase:
+            line += "  %10.0f items/s" % phase["items_per_second"]
+        if "rpr_calls" in phase:
+            line += "  %8d RPR calls" % phase["rpr_calls"]
+        if baseline and name in baseline["phases"]:
+            line += "  %+6.1f%%" % ((phase["seconds"] / baseline["phases"][name]["seconds"] - 1) * 100)
+        print(line)
+
+
+# Phases that got slower than the baseline by more than the tolerance
+def get_regressions(report, baseline, tolerance):
+    regressions = []
+    for name, phase in report["phases"].items():
+        if name not in baseline["phases"]: continue
+        if phase["seconds"] > baseline["phases"][name]["seconds"] * (1 + tolerance):
+            regressions.append(name)
+    return regressions
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Benchmark AAF import on a synthetic AAF file.")
+    parser.add_argument("--masters", type=int, default=8, help="number of embedded master clips")
+    parser.add_argument("--seconds", type=float, default=10.0, help="length of each master clip")
+    parser.add_argument("--rate", type=int, default=48000, help="sample rate of the master clips")
+    parser.add_argument("--tracks", type=int, default=8, help="number of tracks")
+    parser.add_argument("--clips", type=int, default=100, help="clips per track")
+    parser.add_argument("--points", type=int, default=50, help="automation points per automated clip")
+    parser.add_argument("--transitions", type=int, default=4,
+        help="make every nth cut a crossfade, 0 for none")
+    parser.add_argument("--nesting", type=int, default=2, help="OperationGroups around automated clips")
+    parser.add_argument("-j", "--workers", type=int, default=0, help="essence extraction processes")
+    parser.add_argument("-p", "--parse-workers", type=int, default=0, help="timeline parsing processes")
+    parser.add_argument("--consolidate", action="store_true", help="extract only the used parts of the media")
+    parser.add_argument("--no-memory", dest="memory", action="store_false",
+        help="don't trace peak memory, which slows down every phase")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="compare timings to results written earlier with --json")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+        help="fraction a phase may be slower than in the compared results (default: 0.2)")
+    return parser
+
+
+def main():
+    parser = get_parser()
+    arguments = parser.parse_args()
+    baseline = None
+    if arguments.compare:
+        with open(arguments.compare, "r") as f:
+            baseline = json.load(f)
+        # The same timeline as the baseline, unless asked otherwise
+        parser.set_defaults(**{name: value for name, value in baseline["settings"].items()
+            if hasattr(arguments, name)})
+        arguments = parser.parse_args()
+
+    report = run_benchmark(arguments)
+    print_report(report, baseline)
+    if arguments.json:
+        with open(arguments.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if baseline:
+        regressions = get_regressions(report, baseline, arguments.tolerance)
+        if regressions:
+            print("Slower than %s: %s" % (arguments.compare, ", ".join(regressions)))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,14 +3,28 @@
 import aaf2
 import os
 import sys
-import wave
+import struct
+import math
 import urllib.parse
 import urllib.request
 import pprint
 import json
+import argparse
+import hashlib
+import shutil
+import tempfile
+import time
+import contextlib
+import threading
+import queue
+import array
+import bisect
+import multiprocessing
+import concurrent.futures
 
 have_reaper = True
 have_tk = True
+have_numpy = True
 
 try:
     from reaper_python import *
@@ -27,22 +41,397 @@ if have_reaper:
 else:
     have_tk = False
 
+# Envelopes are processed as whole arrays when NumPy is available
+try:
+    import numpy
+except ModuleNotFoundError:
+    have_numpy = False
+
+# Peak memory in the profile report, not available on Windows
+try:
+    import resource
+except ModuleNotFoundError:
+    resource = None
+
 [NOTICE, WARNING, ERROR, NONE] = range(4)
 log_level = WARNING
 
+# Embedded essence is copied to disk in blocks of this many bytes,
+# so memory use doesn't depend on the size of the media.
+essence_chunk_size = 4 * 1024 * 1024
+
+# Number of worker processes used to extract embedded essence.
+# 0 or 1 extracts everything in the current process.
+extraction_workers = 0
+
+# Number of worker processes used to parse the slots of a composition.
+# Each of them opens the AAF itself, so this pays off for compositions
+# with many long tracks. 0 or 1 parses everything in the current process.
+parsing_workers = 0
+
+# Number of AAF files converted at once in batch mode, 0 uses every core.
+batch_workers = 0
+
+# REAPER's embedded interpreter can't start worker processes by itself,
+# so the pool needs the path to a regular Python executable to use there.
+worker_python = None
+
+# Keep a manifest of extracted essence next to the extracted files,
+# so re-importing the same media doesn't write it all again.
+use_essence_cache = True
+
+# Set when several imports extract into the same media directory at once,
+# as in batch mode. Files are then named after their content and each
+# essence is extracted by whichever import claims it first.
+shared_media = False
+
+# Directories searched, including their subdirectories, for linked media
+# that isn't where the AAF says it is, or next to the AAF.
+# They are scanned once per import, however many files are linked.
+media_search_paths = []
+
+# Only essence used by the selected composition is extracted by default.
+# Set this to extract the media of every master mob in the file.
+extract_unused_essence = False
+
+# Consolidate mode writes only the parts of each embedded source that the
+# timeline uses, plus handles of this many seconds on either side.
+# Items are moved to match the trimmed files.
+consolidate = False
+consolidate_handles = 1.0
+
+# Write the mono sound slots of each master mob, as recorders with many
+# iso tracks produce them, into one multichannel file instead of a file
+# per slot. Items then play their channel of it. Slots only share a file
+# if they have the same sample rate and depth. Not used when consolidating.
+interleave_channels = False
+
+# Write REAPER peak files (.reapeaks) next to extracted PCM essence while
+# extracting it, so REAPER doesn't read every file again to draw waveforms.
+# Needs NumPy, without it REAPER builds the peaks itself as usual.
+write_peak_files = True
+
+# Build each track in REAPER from a single state chunk instead of
+# creating and adjusting every item through the API.
+build_with_chunks = True
+
+# Re-conform the open project to a revised AAF instead of adding tracks.
+# Imported items are tagged with the master mob slot, source offset and
+# position they came from, and a later import only adds, moves, trims
+# or deletes the items that differ from the new timeline. Items are only
+# tagged while this is set, so it has to be on for the first import too.
+reconform = False
+
+# Envelope points are dropped as long as the curve doesn't move by more
+# than this, in dB for volume and pan units (-1 to 1) for panning.
+# 0 only drops points that change nothing at all.
+volume_envelope_tolerance = 0.1
+panning_envelope_tolerance = 0.01
+
+# Parsed timelines are cached on disk, keyed by the AAF's path, size,
+# modification time and a hash of its header, so importing the same
+# file again doesn't have to go through aaf2 at all.
+# The least recently used entries are dropped once the cache grows
+# beyond timeline_cache_size bytes, 0 disables the cache.
+timeline_cache_size = 256 * 1024 * 1024
+timeline_cache_directory = None
+
+# Time, counts and peak memory of every phase of the import, reported as
+# JSON at the end: to the REAPER console, or stderr outside REAPER.
+# Set to a file name to write the report there, or "1" to just switch it on.
+# The IMPORTAAF_PROFILE environment variable sets this too.
+profile = os.environ.get("IMPORTAAF_PROFILE", "")
+
+# Worker processes collect their messages here instead of printing them,
+# so the main process can show them in order.
+log_records = None
+
+# Outside REAPER messages are printed to this stream, stdout when None.
+# --ndjson moves them to stderr, stdout only carries the records then.
+log_file = None
+
 def log(message, level=NOTICE):
+    if log_records is not None:
+        log_records.append((message, level))
+        return
+    write_log(message, level)
+
+def write_log(message, level=NOTICE):
     if log_level > level: return
     if have_reaper:
         RPR_ShowConsoleMsg(message + "\n")
     else:
-        print(message)
+        print(message, file=log_file)
+
+
+
+# Collects the numbers for the profile report. Everything is a no-op
+# until enable() is called, phases then measure wall and CPU time and
+# RPR_* functions are wrapped to count how often they are called.
+class Profiler:
+
+    def __init__(self):
+        self.enabled = False
+        self.output = None
+        self.phases = {}
+        self.counts = {}
+        self.rpr_calls = {}
+        self.started = None
+        self.null_phase = contextlib.nullcontext()
+
+    def enable(self, output, namespace):
+        self.enabled = True
+        self.output = output
+        self.started = (time.perf_counter(), time.process_time())
+        for name, function in list(namespace.items()):
+            if name.startswith("RPR_") and callable(function):
+                namespace[name] = self.count_calls(name, function)
+
+    def count_calls(self, name, function):
+        def call(*args):
+            self.rpr_calls[name] = self.rpr_calls.get(name, 0) + 1
+            return function(*args)
+        return call
+
+    def phase(self, name):
+        if not self.enabled:
+            return self.null_phase
+        return self.measure(name)
+
+    @contextlib.contextmanager
+    def measure(self, name):
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            phase = self.phases.setdefault(name, {"wall": 0.0, "cpu": 0.0, "calls": 0})
+            phase["wall"] += time.perf_counter() - wall
+            phase["cpu"] += time.process_time() - cpu
+            phase["calls"] += 1
+
+    def count(self, name, value=1):
+        if not self.enabled: return
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def count_file(self, filename):
+        if not self.enabled: return
+        self.count("files_extracted")
+        try:
+            self.count("bytes_extracted", os.path.getsize(filename))
+        except OSError:
+            pass
+
+    # In MB, for this process and its finished worker processes
+    def get_peak_rss(self):
+        if resource is None: return None
+        # ru_maxrss is in bytes on macOS, in kilobytes elsewhere
+        unit = 1024 * 1024 if sys.platform == "darwin" else 1024
+        return {
+            "self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit,
+            "workers": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / unit
+        }
+
+    def get_report(self):
+        report = {
+            "wall": time.perf_counter() - self.started[0],
+            "cpu": time.process_time() - self.started[1],
+            "phases": self.phases,
+            "counts": self.counts,
+            "rpr_calls": sum(self.rpr_calls.values()),
+            "rpr_functions": self.rpr_calls,
+            "peak_rss_mb": self.get_peak_rss()
+        }
+        extraction = self.phases.get("extract_essence", None)
+        if extraction and extraction["wall"] > 0 and "bytes_extracted" in self.counts:
+            report["extraction_mb_per_second"] = self.counts["bytes_extracted"] / (1024 * 1024) / extraction["wall"]
+        return report
+
+    def report(self):
+        if not self.enabled: return
+        report = json.dumps(self.get_report(), indent=2)
+        if self.output and self.output != "1":
+            try:
+                with open(self.output, "w") as f:
+                    f.write(report)
+                log("Wrote profile report to %s" % self.output)
+                return
+            except OSError:
+                log("Could not write profile report %s" % self.output, WARNING)
+        if have_reaper:
+            RPR_ShowConsoleMsg(report + "\n")
+        else:
+            sys.stderr.write(report + "\n")
+
+profiler = Profiler()
+
+
+
+class ExtractionCancelled(Exception):
+    pass
+
+# Passes progress from the extraction thread to the dialog showing it.
+# Only the thread running the dialog may call into REAPER, so messages
+# the extraction logs go through the queue as well (see append).
+class ExtractionProgress:
+
+    def __init__(self):
+        self.events = queue.Queue()
+        self.cancel_event = threading.Event()
+
+    def set_total(self, size):
+        self.events.put(("total", size))
+
+    def advance(self, size):
+        self.events.put(("bytes", size))
+        if self.cancel_event.is_set():
+            raise ExtractionCancelled()
+
+    def message(self, message):
+        self.events.put(("message", message))
+
+    # Lets the progress stand in for log_records
+    def append(self, record):
+        self.events.put(("log", record))
+
+    def finish(self, result):
+        self.events.put(("finished", result))
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def is_cancelled(self):
+        return self.cancel_event.is_set()
+
+    def get_events(self):
+        while True:
+            try:
+                yield self.events.get_nowait()
+            except queue.Empty:
+                return
+
+
+
+class ChunkRenderer:
+
+    video_extensions = [".mov", ".mp4", ".m4v", ".mxf", ".avi", ".mkv", ".mpg", ".mpeg", ".wmv"]
+    # Compressed audio needs its own source type, REAPER shows
+    # these as offline when they're declared as WAVE.
+    audio_source_types = {".mp3": "MP3", ".flac": "FLAC", ".ogg": "VORBIS", ".opus": "OPUS"}
+
+    # Source paths are written relative to base_directory when one is given,
+    # so a project can be moved along with its media.
+    def __init__(self, base_directory=None):
+        self.base_directory = base_directory
+
+    def quote(self, text):
+        text = str(text).replace("\n", " ")
+        for quote in ['"', "'"]:
+            if quote not in text:
+                return quote + text + quote
+        return "`" + text.replace("`", "'") + "`"
+
+    def number(self, value):
+        return "%.10f" % value
+
+    def source_path(self, filename):
+        if not self.base_directory or not filename:
+            return filename
+        try:
+            return os.path.relpath(os.path.abspath(filename), self.base_directory)
+        except ValueError:
+            # Different drive on Windows
+            return os.path.abspath(filename)
+
+    def source_type(self, filename):
+        extension = os.path.splitext(filename)[1].lower()
+        if extension in self.video_extensions:
+            return "VIDEO"
+        return self.audio_source_types.get(extension, "WAVE")
+
+    def render_envelope(self, name, points):
+        lines = [
+            "<" + name,
+            "ACT 1 -1",
+            "VIS 1 1 1",
+            "LANEHEIGHT 0 0",
+            "ARM 0",
+            "DEFSHAPE 0 -1 -1"
+        ]
+        for point in sorted(points, key=lambda point: point["time"]):
+            lines.append("PT %s %s 0" % (self.number(point["time"]), self.number(point["value"])))
+        lines.append(">")
+        return lines
+
+    def render_item(self, item_data):
+        lines = [
+            "<ITEM",
+            "POSITION " + self.number(item_data["position"]),
+            "LENGTH " + self.number(item_data["duration"])
+        ]
+        if item_data.get("fadein", None):
+            shape = item_data.get("fadeintype", 0)
+            lines.append("FADEIN %d %s 0 %d 0 0 0" % (shape, self.number(item_data["fadein"]), shape))
+        if item_data.get("fadeout", None):
+            shape = item_data.get("fadeouttype", 0)
+            lines.append("FADEOUT %d %s 0 %d 0 0 0" % (shape, self.number(item_data["fadeout"]), shape))
+        lines.append("VOLPAN %s 0 1 -1" % self.number(item_data.get("volume", 1.0)))
+        if "channel" in item_data:
+            # Mono channel modes start at 3 for the first channel
+            lines.append("CHANMODE %d" % (item_data["channel"] + 3))
+        lines.append("SOFFS " + self.number(item_data["offset"]))
+        lines.append("NAME " + self.quote(os.path.basename(item_data["source"])))
+        lines.append("<SOURCE " + self.source_type(item_data["source"]))
+        lines.append("FILE " + self.quote(self.source_path(item_data["source"])))
+        lines.append(">")
+        lines.append(">")
+        return lines
+
+    def render_track(self, track_data):
+        lines = [
+            "<TRACK",
+            "NAME " + self.quote(track_data["name"]),
+            "VOLPAN %s %s -1 -1 1" % (
+                self.number(track_data.get("volume", 1.0)),
+                self.number(track_data.get("panning", 0.0))
+            )
+        ]
+        # Volume points are plain amplitude, since the chunk has no VOLTYPE line.
+        if "volume_envelope" in track_data:
+            lines += self.render_envelope("VOLENV2", track_data["volume_envelope"])
+        if "panning_envelope" in track_data:
+            lines += self.render_envelope("PANENV2", track_data["panning_envelope"])
+        for item_data in track_data.get("items", []):
+            lines += self.render_item(item_data)
+        lines.append(">")
+        return "\n".join(lines)
+
+    def render_marker(self, index, marker_data):
+        colour_code = 0
+        colour = marker_data.get("colour", None)
+        if colour:
+            colour_code = colour["r"] | colour["g"] << 8 | colour["b"] << 16 | 0x1000000
+        return "MARKER %d %s %s 0 %d" % (
+            index,
+            self.number(marker_data["position"]),
+            self.quote(marker_data.get("name", "")),
+            colour_code
+        )
+
+    def write_project(self, filename, data):
+        with open(filename, "w", encoding="utf-8") as f:
+            f.write("<REAPER_PROJECT 0.1 \"6.0/importaaf\" 0\n")
+            for index, marker_data in enumerate(data["markers"], 1):
+                f.write(self.render_marker(index, marker_data) + "\n")
+            for track_data in data["tracks"]:
+                f.write(self.render_track(track_data) + "\n")
+            f.write(">\n")
 
 
 
 class ReaperInterface:
 
     def __init__(self):
-        self.insertion_track = None
+        self.sources = {}
 
     def select_aaf(self):
         ok, filename, _, _ = RPR_GetUserFileNameForRead("", "Import AAF", ".aaf")
@@ -63,10 +452,23 @@ class ReaperInterface:
     def set_track_volume(self, track, volume):
         RPR_SetMediaTrackInfo_Value(track, "D_VOL", volume)
 
+    def get_track_envelope(self, track, name):
+        envelope = RPR_GetTrackEnvelopeByName(track, name)
+        if not RPR_ValidatePtr2(0, envelope, "TrackEnvelope*"):
+            return None
+        return envelope
+
+    # Shows a track envelope, unless it's there already
+    def show_track_envelope(self, track, name, command):
+        envelope = self.get_track_envelope(track, name)
+        if envelope is None:
+            RPR_SetOnlyTrackSelected(track)
+            RPR_Main_OnCommand(command, 0)
+            envelope = RPR_GetTrackEnvelopeByName(track, name)
+        return envelope
+
     def set_track_volume_envelope(self, track, volume_data):
-        RPR_SetOnlyTrackSelected(track)
-        RPR_Main_OnCommand(40406, 0)  # ReaSlang for "toggle volume envelope visible"
-        envelope = RPR_GetTrackEnvelopeByName(track, "Volume")
+        envelope = self.show_track_envelope(track, "Volume", 40406)  # ReaSlang for "toggle volume envelope visible"
         for point in volume_data:
             value = RPR_ScaleToEnvelopeMode(1, point["value"])
             RPR_InsertEnvelopePoint(envelope, point["time"], value, 0, 0.0, False, True)
@@ -76,23 +478,29 @@ class ReaperInterface:
         RPR_SetMediaTrackInfo_Value(track, "D_PAN", panning)
 
     def set_track_panning_envelope(self, track, panning_data):
-        RPR_SetOnlyTrackSelected(track)
-        RPR_Main_OnCommand(40407, 0)  # Toggle pan envelope visible
-        envelope = RPR_GetTrackEnvelopeByName(track, "Pan")
+        envelope = self.show_track_envelope(track, "Pan", 40407)  # Toggle pan envelope visible
         for point in panning_data:
             RPR_InsertEnvelopePoint(envelope, point["time"], point["value"], 0, 0.0, False, True)
         RPR_Envelope_SortPoints(envelope)
 
-    def create_item(self, track, src, offset, pos, dur):
-        RPR_SetOnlyTrackSelected(self.insertion_track)
-        RPR_MoveEditCursor(-1000, False)
-        RPR_InsertMedia(src, 0)
-        item = RPR_GetTrackMediaItem(self.insertion_track, 0)
-        RPR_MoveMediaItemToTrack(item, track)
+    # Media files are opened and probed once, all items using the same file
+    # share its source.
+    def get_source(self, filename):
+        if filename not in self.sources:
+            self.sources[filename] = RPR_PCM_Source_CreateFromFile(filename)
+        return self.sources[filename]
+
+    def create_item(self, track, src, offset, pos, dur, channel=None):
+        item = RPR_AddMediaItemToTrack(track)
+        take = RPR_AddTakeToMediaItem(item)
+        RPR_SetMediaItemTake_Source(take, self.get_source(src))
+        # Named after the file, as RPR_InsertMedia and the chunk builder do
+        RPR_GetSetMediaItemTakeInfo_String(take, "P_NAME", os.path.basename(src), True)
         RPR_SetMediaItemInfo_Value(item, "D_POSITION", pos)
         RPR_SetMediaItemInfo_Value(item, "D_LENGTH", dur)
-        take = RPR_GetMediaItemTake(item, 0)
         RPR_SetMediaItemTakeInfo_Value(take, "D_STARTOFFS", offset)
+        if channel is not None:
+            RPR_SetMediaItemTakeInfo_Value(take, "I_CHANMODE", channel + 3)
         return item
 
     def set_item_fades(self, item, fadein=None, fadeout=None, fadeintype=0, fadeouttype=0):
@@ -113,59 +521,1169 @@ class ReaperInterface:
         RPR_AddProjectMarker2(0, False, pos, 0.0, name, 0, colour_code)
 
     def build_project(self, data):
-        self.insertion_track = self.create_track("Insertion")
+        if reconform:
+            self.reconform_project(data)
+        elif build_with_chunks:
+            self.build_project_chunks(data)
+        else:
+            self.build_project_items(data)
+
+    # Every track is rendered to a state chunk and applied in one call,
+    # all inside one undo block and without redrawing in between.
+    def build_project_chunks(self, data):
+        renderer = ChunkRenderer()
+        RPR_Undo_BeginBlock2(0)
+        RPR_PreventUIRefresh(1)
+        try:
+            for track_data in data["tracks"]:
+                self.build_track(track_data, renderer)
+
+            for marker_data in data["markers"]:
+                self.create_marker(marker_data["position"], marker_data.get("name", ""), marker_data.get("colour", None))
+        finally:
+            RPR_PreventUIRefresh(-1)
+            RPR_Undo_EndBlock2(0, "Import AAF", -1)
+        RPR_TrackList_AdjustWindows(False)
+        RPR_UpdateArrange()
+
+    def build_project_items(self, data):
+        self.sources = {}
 
         for track_data in data["tracks"]:
-            track = self.create_track(track_data["name"])
-
-            if "volume" in track_data:
-                self.set_track_volume(track, track_data["volume"])
-            if "panning" in track_data:
-                self.set_track_panning(track, track_data["panning"])
-            if "volume_envelope" in track_data:
-                self.set_track_volume_envelope(track, track_data["volume_envelope"])
-            if "panning_envelope" in track_data:
-                self.set_track_panning_envelope(track, track_data["panning_envelope"])
-
-            if "items" not in track_data: continue
-            for item_data in track_data["items"]:
-                item = self.create_item(
-                    track,
-                    item_data["source"],
-                    item_data["offset"],
-                    item_data["position"],
-                    item_data["duration"]
-                )
-                if "fadein" in item_data or "fadeout" in item_data:
-                    self.set_item_fades(
-                        item,
-                        item_data.get("fadein", None),
-                        item_data.get("fadeout", None),
-                        item_data.get("fadeintype", 0),
-                        item_data.get("fadeouttype", 0)
-                    )
-                if "volume" in item_data:
-                    self.set_item_volume(item, item_data["volume"])
+            self.build_track(track_data)
 
         for marker_data in data["markers"]:
             self.create_marker(marker_data["position"], marker_data.get("name", ""), marker_data.get("colour", None))
 
-        RPR_DeleteTrack(self.insertion_track)
-        self.insertion_track = None
+        self.sources = {}
+
+    def build_track(self, track_data, renderer=None):
+        track = self.create_track(track_data["name"])
+        if renderer:
+            RPR_SetTrackStateChunk(track, renderer.render_track(track_data), False)
+            if reconform:
+                self.tag_track(track, track_data, self.track_envelopes)
+                # REAPER keeps the items of a track sorted by position
+                items = sorted(track_data.get("items", []), key=lambda item_data: item_data["position"])
+                for i, item_data in enumerate(items):
+                    self.tag_item(RPR_GetTrackMediaItem(track, i), item_data)
+            return track
+
+        if "volume" in track_data:
+            self.set_track_volume(track, track_data["volume"])
+        if "panning" in track_data:
+            self.set_track_panning(track, track_data["panning"])
+        if "volume_envelope" in track_data:
+            self.set_track_volume_envelope(track, track_data["volume_envelope"])
+        if "panning_envelope" in track_data:
+            self.set_track_panning_envelope(track, track_data["panning_envelope"])
+        if reconform:
+            self.tag_track(track, track_data, self.track_envelopes)
+
+        for item_data in track_data.get("items", []):
+            item = self.build_item(track, item_data)
+            if reconform:
+                self.tag_item(item, item_data)
+        return track
+
+    def build_item(self, track, item_data):
+        item = self.create_item(
+            track,
+            item_data["source"],
+            item_data["offset"],
+            item_data["position"],
+            item_data["duration"],
+            item_data.get("channel", None)
+        )
+        if "fadein" in item_data or "fadeout" in item_data:
+            self.set_item_fades(
+                item,
+                item_data.get("fadein", None),
+                item_data.get("fadeout", None),
+                item_data.get("fadeintype", 0),
+                item_data.get("fadeouttype", 0)
+            )
+        if "volume" in item_data:
+            self.set_item_volume(item, item_data["volume"])
+        return item
+
+    # Imported items remember what they were imported as. Later imports
+    # compare this to the new timeline, so properties changed by hand
+    # in REAPER are only overwritten when the AAF changed them too.
+    item_state = ["mob_id", "slot_id", "source", "offset", "position", "duration",
+        "fadein", "fadeintype", "fadeout", "fadeouttype", "volume", "channel"]
+
+    def tag_item(self, item, item_data):
+        state = {name: item_data[name] for name in self.item_state if name in item_data}
+        RPR_GetSetMediaItemInfo_String(item, "P_EXT:importaaf", json.dumps(state), True)
+
+    # Track envelopes are remembered both as the AAF had them and as REAPER
+    # holds them after importing, which tells whether they were edited since.
+    track_envelopes = {
+        "volume_envelope": ("Volume", "set_track_volume_envelope"),
+        "panning_envelope": ("Pan", "set_track_panning_envelope")
+    }
+
+    def get_checksum(self, data):
+        return hashlib.sha1(json.dumps(data).encode()).hexdigest()
+
+    def get_envelope_points(self, envelope):
+        points = []
+        if envelope is None: return points
+        for i in range(RPR_CountEnvelopePoints(envelope)):
+            result = RPR_GetEnvelopePoint(envelope, i, 0.0, 0.0, 0, 0.0, False)
+            points.append((round(result[3], 6), round(result[4], 6), result[5]))
+        return points
+
+    def get_track_state(self, track):
+        value = RPR_GetSetMediaTrackInfo_String(track, "P_EXT:importaaf", "", False)[3]
+        try:
+            return json.loads(value) if value else {}
+        except ValueError:
+            return {}
+
+    def tag_track(self, track, track_data, names):
+        state = self.get_track_state(track)
+        for name in names:
+            envelope = self.get_track_envelope(track, self.track_envelopes[name][0])
+            state[name] = {
+                "aaf": self.get_checksum(track_data.get(name, None)),
+                "reaper": self.get_checksum(self.get_envelope_points(envelope))
+            }
+        RPR_GetSetMediaTrackInfo_String(track, "P_EXT:importaaf", json.dumps(state), True)
+
+    # Envelopes the AAF changed are replaced, unless they were edited in
+    # REAPER too. Returns the names of those that were left alone.
+    def reconform_track_envelopes(self, track, track_data):
+        state = self.get_track_state(track)
+        replaced = []
+        edited = []
+        for name, (envelope_name, set_envelope) in self.track_envelopes.items():
+            # Tracks imported without tags count as having had no envelopes
+            tag = state.get(name, {"aaf": self.get_checksum(None), "reaper": self.get_checksum([])})
+            if tag["aaf"] == self.get_checksum(track_data.get(name, None)): continue
+            envelope = self.get_track_envelope(track, envelope_name)
+            points = self.get_envelope_points(envelope)
+            if self.get_checksum(points) != tag["reaper"]:
+                edited.append(envelope_name)
+                continue
+            if points:
+                RPR_DeleteEnvelopePointRange(envelope, points[0][0] - 1.0, points[-1][0] + 1.0)
+            if name in track_data:
+                getattr(self, set_envelope)(track, track_data[name])
+            replaced.append(name)
+        if replaced:
+            self.tag_track(track, track_data, replaced)
+        return edited
+
+    def get_tagged_items(self, track):
+        items = []
+        for i in range(RPR_CountTrackMediaItems(track)):
+            item = RPR_GetTrackMediaItem(track, i)
+            value = RPR_GetSetMediaItemInfo_String(item, "P_EXT:importaaf", "", False)[3]
+            if not value: continue
+            try:
+                items.append((item, json.loads(value)))
+            except ValueError:
+                pass
+        return items
+
+    def get_marker_keys(self):
+        keys = set()
+        i = 0
+        while True:
+            result = RPR_EnumProjectMarkers(i, False, 0, 0, "", 0)
+            if not result[0]: break
+            if not result[2]:
+                keys.add((round(result[3], 6), result[5]))
+            i += 1
+        return keys
+
+    # Tracks are matched by name, in order when several share one.
+    # Tracks the AAF doesn't have any more, untagged items and the
+    # settings, FX and other automation of matched tracks are left alone.
+    def reconform_project(self, data):
+        self.sources = {}
+        renderer = ChunkRenderer() if build_with_chunks else None
+        tracks = {}
+        for i in range(RPR_GetNumTracks()):
+            track = RPR_GetTrack(0, i)
+            name = RPR_GetSetMediaTrackInfo_String(track, "P_NAME", "", False)[3]
+            tracks.setdefault(name, []).append(track)
+
+        counts = {"kept": 0, "changed": 0, "added": 0, "deleted": 0}
+        edited = []
+        RPR_Undo_BeginBlock2(0)
+        RPR_PreventUIRefresh(1)
+        try:
+            for track_data in data["tracks"]:
+                existing = tracks.get(track_data["name"], None)
+                if existing:
+                    track = existing.pop(0)
+                    edited += ["%s (%s)" % (track_data["name"], name)
+                        for name in self.reconform_track_envelopes(track, track_data)]
+                    self.reconform_track(track, track_data, counts)
+                else:
+                    self.build_track(track_data, renderer)
+                    counts["added"] += len(track_data.get("items", []))
+
+            markers = self.get_marker_keys()
+            for marker_data in data["markers"]:
+                name = marker_data.get("name", "")
+                if (round(marker_data["position"], 6), name) in markers: continue
+                self.create_marker(marker_data["position"], name, marker_data.get("colour", None))
+        finally:
+            RPR_PreventUIRefresh(-1)
+            RPR_Undo_EndBlock2(0, "Re-conform AAF", -1)
+        RPR_TrackList_AdjustWindows(False)
+        RPR_UpdateArrange()
+        self.sources = {}
+        log("Re-conformed items: %(kept)d unchanged, %(changed)d changed, %(added)d added, %(deleted)d deleted" % counts)
+        if edited:
+            log("Envelopes changed in the AAF but edited in REAPER were kept: %s" % ", ".join(edited), WARNING)
+
+    # Keys for matching tagged items to new ones, tried in turn:
+    # the same clip at the same place, then the same clip moved.
+    match_keys = [
+        lambda state: (state.get("mob_id"), state.get("slot_id"),
+            round(state["offset"], 6), round(state["position"], 6)),
+        lambda state: (state.get("mob_id"), state.get("slot_id"), round(state["offset"], 6))
+    ]
+
+    def reconform_track(self, track, track_data, counts):
+        new_items = track_data.get("items", [])
+        unmatched = list(range(len(new_items)))
+        old_items = self.get_tagged_items(track)
+        matches = {}
+        for get_key in self.match_keys:
+            candidates = {}
+            for old_item in old_items:
+                candidates.setdefault(get_key(old_item[1]), []).append(old_item)
+            remaining = []
+            for i in unmatched:
+                found = candidates.get(get_key(new_items[i]), None)
+                if found:
+                    matches[i] = found.pop(0)
+                else:
+                    remaining.append(i)
+            unmatched = remaining
+            old_items = [old_item for found in candidates.values() for old_item in found]
+
+        # Trimmed clips still cover part of the same source,
+        # the one covering the most of it is taken.
+        candidates = {}
+        for old_item in old_items:
+            candidates.setdefault((old_item[1].get("mob_id"), old_item[1].get("slot_id")), []).append(old_item)
+        remaining = []
+        for i in unmatched:
+            item_data = new_items[i]
+            best = None
+            best_overlap = 0.0
+            for old_item in candidates.get((item_data.get("mob_id"), item_data.get("slot_id")), []):
+                state = old_item[1]
+                overlap = min(state["offset"] + state["duration"], item_data["offset"] + item_data["duration"]) \
+                    - max(state["offset"], item_data["offset"])
+                if overlap > best_overlap:
+                    best, best_overlap = old_item, overlap
+            if best:
+                candidates[(item_data.get("mob_id"), item_data.get("slot_id"))].remove(best)
+                matches[i] = best
+            else:
+                remaining.append(i)
+        old_items = [old_item for found in candidates.values() for old_item in found]
+
+        for i, (item, state) in matches.items():
+            if self.update_item(item, state, new_items[i]):
+                counts["changed"] += 1
+            else:
+                counts["kept"] += 1
+        for item, state in old_items:
+            RPR_DeleteTrackMediaItem(track, item)
+            counts["deleted"] += 1
+        for i in remaining:
+            self.tag_item(self.build_item(track, new_items[i]), new_items[i])
+            counts["added"] += 1
+
+    def update_item(self, item, state, item_data):
+        changed = [name for name in self.item_state if state.get(name, None) != item_data.get(name, None)]
+        if not changed:
+            return False
+        take = RPR_GetActiveTake(item)
+        if "position" in changed:
+            RPR_SetMediaItemInfo_Value(item, "D_POSITION", item_data["position"])
+        if "duration" in changed:
+            RPR_SetMediaItemInfo_Value(item, "D_LENGTH", item_data["duration"])
+        if "offset" in changed:
+            RPR_SetMediaItemTakeInfo_Value(take, "D_STARTOFFS", item_data["offset"])
+        if "source" in changed:
+            RPR_SetMediaItemTake_Source(take, self.get_source(item_data["source"]))
+            RPR_GetSetMediaItemTakeInfo_String(take, "P_NAME", os.path.basename(item_data["source"]), True)
+        if "fadein" in changed or "fadeintype" in changed:
+            RPR_SetMediaItemInfo_Value(item, "D_FADEINLEN", item_data.get("fadein", None) or 0.0)
+            RPR_SetMediaItemInfo_Value(item, "C_FADEINSHAPE", item_data.get("fadeintype", None) or 0)
+        if "fadeout" in changed or "fadeouttype" in changed:
+            RPR_SetMediaItemInfo_Value(item, "D_FADEOUTLEN", item_data.get("fadeout", None) or 0.0)
+            RPR_SetMediaItemInfo_Value(item, "C_FADEOUTSHAPE", item_data.get("fadeouttype", None) or 0)
+        if "volume" in changed:
+            self.set_item_volume(item, item_data.get("volume", 1.0))
+        if "channel" in changed:
+            channel = item_data.get("channel", None)
+            RPR_SetMediaItemTakeInfo_Value(take, "I_CHANMODE", 0 if channel is None else channel + 3)
+        self.tag_item(item, item_data)
+        return True
+
+
+
+class WavWriter:
+
+    # Plain RIFF sizes are 32 bits. Bigger files get an RF64 header,
+    # for which we reserve room with a JUNK chunk up front.
+    riff_limit = 0xFFFFFFFF
+    ds64_size = 28
+
+    def __init__(self, fname, depth=16, rate=48000, channels=1):
+        self.file = open(fname, "wb")
+        self.block_align = channels * int(depth / 8)
+        self.data_size = 0
+
+        rate = int(rate)
+        self.file.write(b"RIFF" + struct.pack("<I", 0) + b"WAVE")
+        self.file.write(b"JUNK" + struct.pack("<I", self.ds64_size) + bytes(self.ds64_size))
+        self.file.write(b"fmt " + struct.pack("<IHHIIHH", 16, 1, channels, rate,
+            rate * self.block_align, self.block_align, depth))
+        self.file.write(b"data" + struct.pack("<I", 0))
+        self.data_offset = self.file.tell()
+
+    def write(self, data):
+        self.file.write(data)
+        self.data_size += len(data)
+
+    def close(self):
+        if self.data_size % 2:
+            self.file.write(b"\0")
+        riff_size = self.file.tell() - 8
+
+        if riff_size > self.riff_limit:
+            self.file.seek(0)
+            self.file.write(b"RF64" + struct.pack("<I", 0xFFFFFFFF))
+            self.file.seek(12)
+            self.file.write(b"ds64" + struct.pack("<IQQQI", self.ds64_size, riff_size,
+                self.data_size, self.data_size // self.block_align, 0))
+            self.file.seek(self.data_offset - 4)
+            self.file.write(struct.pack("<I", 0xFFFFFFFF))
+        else:
+            self.file.seek(4)
+            self.file.write(struct.pack("<I", riff_size))
+            self.file.seek(self.data_offset - 4)
+            self.file.write(struct.pack("<I", self.data_size))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+
+# Reads several mono PCM streams of the same format as one interleaved
+# multichannel stream. Each block is interleaved with one slice assignment
+# per byte of a sample, streams that end early are padded with silence.
+class InterleavedStream:
+
+    def __init__(self, streams, sample_width):
+        self.streams = streams
+        self.sample_width = sample_width
+        self.frame_size = len(streams) * sample_width
+
+    def read_block(self, stream, size):
+        block = bytearray()
+        while len(block) < size:
+            data = stream.read(size - len(block))
+            if not data: break
+            block += data
+        return block
+
+    def read(self, size):
+        frames = max(size // self.frame_size, 1)
+        sample_width = self.sample_width
+        blocks = [self.read_block(stream, frames * sample_width) for stream in self.streams]
+        frames = max(len(block) for block in blocks) // sample_width
+        if frames == 0:
+            return b""
+
+        size = frames * sample_width
+        data = bytearray(frames * self.frame_size)
+        for channel, block in enumerate(blocks):
+            block = block[:size] + bytes(max(size - len(block), 0))
+            for byte in range(sample_width):
+                data[channel * sample_width + byte::self.frame_size] = block[byte::sample_width]
+        return data
+
+
+
+# Min/max peaks of PCM data in REAPER's peak file format, built from
+# the blocks as they are written. The first mipmap has about 400 peaks
+# per second, the others are built from it.
+class PeakBuilder:
+
+    peaks_per_second = 400
+    mipmap_factors = [1, 40, 400]
+
+    # The finest peaks go to a temporary file as they are made, hours of
+    # essence have too many of them to keep. The coarser mipmaps are
+    # reduced from them on the way, each keeping the peaks of its last
+    # group until it's complete.
+    def __init__(self, depth, rate, channels):
+        self.depth = depth
+        self.rate = int(rate)
+        self.channels = channels
+        self.block_align = channels * int(depth / 8)
+        self.division = max(int(self.rate / self.peaks_per_second), 1)
+        self.pending_bytes = b""
+        self.pending_frames = numpy.zeros((0, channels), dtype=numpy.int16)
+        self.count = 0
+        self.peak_file = tempfile.TemporaryFile()
+        self.reduced = {factor: [] for factor in self.mipmap_factors[1:]}
+        self.pending_peaks = {factor: numpy.zeros((0, 2, channels), dtype=numpy.int16)
+            for factor in self.mipmap_factors[1:]}
+
+    # Samples scaled to 16 bits, one row per frame
+    def get_frames(self, data):
+        data = numpy.frombuffer(data, dtype=numpy.uint8)
+        if self.depth == 8:
+            samples = (data.astype(numpy.int16) - 128) << 8
+        elif self.depth == 16:
+            samples = data.view("<i2")
+        elif self.depth == 24:
+            data = data.reshape(-1, 3).astype(numpy.int32)
+            samples = ((data[:, 0] << 8 | data[:, 1] << 16 | data[:, 2] << 24) >> 16).astype(numpy.int16)
+        elif self.depth == 32:
+            samples = (data.view("<i4") >> 16).astype(numpy.int16)
+        else:
+            raise ValueError("Unsupported sample depth %d" % self.depth)
+        return samples.reshape(-1, self.channels)
+
+    def add(self, data):
+        data = self.pending_bytes + data
+        usable = len(data) - len(data) % self.block_align
+        self.pending_bytes = data[usable:]
+        frames = self.get_frames(data[:usable])
+        if len(self.pending_frames):
+            frames = numpy.concatenate([self.pending_frames, frames])
+        count = len(frames) // self.division
+        blocks = frames[:count * self.division].reshape(count, self.division, self.channels)
+        self.add_peaks(numpy.stack([blocks.max(axis=1), blocks.min(axis=1)], axis=1))
+        self.pending_frames = frames[count * self.division:]
+
+    # Peaks are (max, min) pairs of rows, one value per channel
+    def add_peaks(self, peaks):
+        if not len(peaks): return
+        self.count += len(peaks)
+        self.peak_file.write(self.get_peak_data(peaks))
+        for factor in self.reduced:
+            peaks_left = numpy.concatenate([self.pending_peaks[factor], peaks])
+            count = len(peaks_left) // factor
+            if count:
+                groups = peaks_left[:count * factor].reshape(count, factor, 2, self.channels)
+                self.reduced[factor].append(self.reduce(groups))
+            self.pending_peaks[factor] = peaks_left[count * factor:]
+
+    def reduce(self, groups):
+        return numpy.stack([groups[:, :, 0].max(axis=1), groups[:, :, 1].min(axis=1)], axis=1)
+
+    # Each peak holds max and min of every channel in turn
+    def get_peak_data(self, peaks):
+        return peaks.transpose(0, 2, 1).astype("<i2").tobytes()
+
+    # The last peak of each mipmap may be made from fewer frames or peaks
+    def finish(self):
+        if len(self.pending_frames):
+            self.add_peaks(numpy.stack([self.pending_frames.max(axis=0, keepdims=True),
+                self.pending_frames.min(axis=0, keepdims=True)], axis=1))
+            self.pending_frames = self.pending_frames[:0]
+        for factor, pending in self.pending_peaks.items():
+            if len(pending):
+                self.reduced[factor].append(self.reduce(pending[numpy.newaxis]))
+                self.pending_peaks[factor] = pending[:0]
+
+    def get_mipmaps(self):
+        self.finish()
+        mipmaps = [(self.division, self.count, None)]
+        for factor, reduced in self.reduced.items():
+            if self.count <= factor: break
+            peaks = numpy.concatenate(reduced)
+            mipmaps.append((self.division * factor, len(peaks), self.get_peak_data(peaks)))
+        return mipmaps
+
+    # REAPER checks the peak file against the source's time and size
+    def write(self, filename, source):
+        stat = os.stat(source)
+        mipmaps = self.get_mipmaps()
+        with open(filename + ".tmp", "wb") as f:
+            f.write(b"RPKN" + struct.pack("<BBIII", self.channels, len(mipmaps), self.rate,
+                int(stat.st_mtime) & 0xFFFFFFFF, stat.st_size & 0xFFFFFFFF))
+            for division, count, _ in mipmaps:
+                f.write(struct.pack("<II", division, count))
+            self.peak_file.seek(0)
+            shutil.copyfileobj(self.peak_file, f, essence_chunk_size)
+            for _, _, data in mipmaps[1:]:
+                f.write(data)
+        os.replace(filename + ".tmp", filename)
+
+    def close(self):
+        self.peak_file.close()
+
+
+
+class EssenceCache:
+
+    manifest_name = ".importaaf_manifest.json"
+
+    # Only the head and tail of each essence stream go into its checksum,
+    # reading the whole stream would cost as much as extracting it.
+    checksum_block_size = 64 * 1024
+
+    # A manifest lock or claim older than this many seconds was left
+    # behind by an import that crashed. Claims are held for as long as
+    # extraction takes, their holder touches them to show it's alive.
+    lock_timeout = 30
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, self.manifest_name)
+        self.stored = {}
+        self.claims = {}
+        self.heartbeat = None
+        self.heartbeat_stop = threading.Event()
+        self.modified = False
+        self.mtime = None
+        self.entries = self.read()
+
+    def read(self):
+        try:
+            self.mtime = os.stat(self.path).st_mtime_ns
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    # Other imports may have written the manifest since it was read,
+    # what this one stored goes on top of their entries.
+    def reload(self):
+        try:
+            if os.stat(self.path).st_mtime_ns == self.mtime: return
+        except OSError:
+            return
+        entries = self.read()
+        for key, entry in self.stored.items():
+            self.set_entry(entries, key, entry)
+        self.entries = entries
+
+    def set_entry(self, entries, key, entry):
+        # Whatever was recorded for this file before has been overwritten.
+        for other in [k for k, e in entries.items() if e["file"] == entry["file"]]:
+            del entries[other]
+        entries[key] = entry
+
+    @classmethod
+    def get_key(cls, mob):
+        stream = mob.essence.open()
+        try:
+            length = stream.seek(0, os.SEEK_END)
+            checksum = hashlib.sha1()
+            stream.seek(0)
+            checksum.update(stream.read(cls.checksum_block_size))
+            if length > cls.checksum_block_size:
+                stream.seek(max(length - cls.checksum_block_size, cls.checksum_block_size))
+                checksum.update(stream.read(cls.checksum_block_size))
+        finally:
+            stream.close()
+        return "%s:%d:%s" % (str(mob.mob_id), length, checksum.hexdigest())
+
+    def lookup(self, key):
+        entry = self.entries.get(key, None)
+        if entry is None: return None
+        filename = os.path.join(self.directory, entry["file"])
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        if stat.st_size != entry["size"] or int(stat.st_mtime) != entry["mtime"]:
+            return None
+        return filename
+
+    def store(self, key, filename):
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return
+        entry = {
+            "file": os.path.basename(filename),
+            "size": stat.st_size,
+            "mtime": int(stat.st_mtime)
+        }
+        self.stored[key] = entry
+        self.set_entry(self.entries, key, entry)
+        self.modified = True
+        # Imports waiting for this essence need to find it in the manifest
+        if key in self.claims:
+            self.save()
+            self.release(key)
+
+    def lock(self):
+        path = self.path + ".lock"
+        while True:
+            try:
+                os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return path
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(path) > self.lock_timeout:
+                        os.remove(path)
+                except OSError:
+                    pass
+                time.sleep(0.01)
+
+    def save(self):
+        if not self.modified: return
+        try:
+            lock = self.lock()
+            try:
+                self.reload()
+                with open(self.path + ".tmp", "w") as f:
+                    json.dump(self.entries, f)
+                os.replace(self.path + ".tmp", self.path)
+                self.mtime = os.stat(self.path).st_mtime_ns
+            finally:
+                os.remove(lock)
+            self.modified = False
+        except OSError:
+            log("Could not write essence manifest %s" % self.path, WARNING)
+
+    def get_claim_path(self, key):
+        return os.path.join(self.directory, ".importaaf_%s.claim" % hashlib.sha1(key.encode()).hexdigest())
+
+    # Imports sharing a media directory claim each essence before
+    # extracting it. Returns False if another import got there first.
+    def claim(self, key):
+        path = self.get_claim_path(key)
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            return False
+        self.claims[key] = path
+        if self.heartbeat is None:
+            self.heartbeat_stop.clear()
+            self.heartbeat = threading.Thread(target=self.touch_claims, daemon=True)
+            self.heartbeat.start()
+        return True
+
+    def touch_claims(self):
+        while not self.heartbeat_stop.wait(self.lock_timeout / 3):
+            for path in list(self.claims.values()):
+                try:
+                    os.utime(path)
+                except OSError:
+                    pass
+
+    def release(self, key):
+        path = self.claims.pop(key, None)
+        if path is None: return
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def release_claims(self):
+        for key in list(self.claims):
+            self.release(key)
+        if self.heartbeat is not None:
+            self.heartbeat_stop.set()
+            self.heartbeat.join()
+            self.heartbeat = None
+
+    # Waits for the import that claimed the essence, returns its file
+    # or None if that import failed to extract it or has died.
+    def wait(self, key):
+        path = self.get_claim_path(key)
+        while True:
+            try:
+                if time.time() - os.path.getmtime(path) > self.lock_timeout:
+                    os.remove(path)
+                    break
+            except OSError:
+                break
+            time.sleep(0.1)
+        self.reload()
+        return self.lookup(key)
+
+    # Claims left behind by imports that didn't finish
+    def clear_claims(self):
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in names:
+            if name.startswith(".importaaf_") and name.endswith(".claim"):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+
+
+class TimelineCache:
+
+    header_size = 64 * 1024
+
+    def __init__(self, directory=None, max_size=None):
+        if directory is None:
+            directory = timeline_cache_directory
+        if directory is None:
+            base = os.environ.get("LOCALAPPDATA") or os.environ.get("XDG_CACHE_HOME") \
+                or os.path.join(os.path.expanduser("~"), ".cache")
+            directory = os.path.join(base, "importaaf")
+        self.directory = directory
+        self.max_size = timeline_cache_size if max_size is None else max_size
+
+    def get_key(self, filename):
+        filename = os.path.abspath(filename)
+        stat = os.stat(filename)
+        with open(filename, "rb") as f:
+            header = hashlib.sha1(f.read(self.header_size)).hexdigest()
+        identity = "%s|%d|%d|%s" % (filename, stat.st_size, stat.st_mtime_ns, header)
+        return hashlib.sha1(identity.encode("utf-8")).hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def load(self, key):
+        path = self.get_path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+            # Entries are evicted by modification time, so using one renews it.
+            os.utime(path)
+            return entry
+        except (OSError, ValueError):
+            return None
+
+    def store(self, key, entry):
+        path = self.get_path(key)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(entry, f)
+            os.replace(path + ".tmp", path)
+        except (OSError, TypeError, ValueError):
+            log("Could not write timeline cache %s" % path, WARNING)
+            return
+        self.evict()
+
+    def get_entries(self):
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return entries
+        for name in names:
+            if not name.endswith(".json"): continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def evict(self):
+        entries = sorted(self.get_entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_size: break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+    def clear(self):
+        for _, _, path in self.get_entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+
+# The timeline is kept in these compact records while it's being parsed,
+# timelines with many thousands of items and automation points would
+# otherwise need a dict per item and per point.
+# to_dict() gives the JSON shape used by build_project and the CLI.
+class Envelope:
+    __slots__ = ("times", "values")
+
+    def __init__(self, times=(), values=()):
+        if have_numpy:
+            self.times = numpy.asarray(times, dtype=numpy.float64)
+            self.values = numpy.asarray(values, dtype=numpy.float64)
+        else:
+            self.times = array.array("d", times)
+            self.values = array.array("d", values)
+
+    # Pieces are concatenated in one go instead of point by point
+    @classmethod
+    def join(cls, times, values):
+        if have_numpy:
+            return cls(numpy.concatenate(times), numpy.concatenate(values))
+        envelope = cls()
+        for piece in times:
+            envelope.times.extend(piece)
+        for piece in values:
+            envelope.values.extend(piece)
+        return envelope
+
+    def __len__(self):
+        return len(self.times)
+
+    def map_times(self, scale, offset=0.0):
+        if have_numpy:
+            return Envelope(self.times * scale + offset, self.values)
+        return Envelope([time * scale + offset for time in self.times], self.values)
+
+    def map_values(self, scale, offset=0.0):
+        if have_numpy:
+            return Envelope(self.times, self.values * scale + offset)
+        return Envelope(self.times, [value * scale + offset for value in self.values])
+
+    # Sorted by time, without repeated points
+    def get_sorted(self):
+        if have_numpy:
+            order = numpy.argsort(self.times, kind="stable")
+            times = self.times[order]
+            values = self.values[order]
+            repeated = numpy.zeros(len(times), dtype=bool)
+            repeated[1:] = (times[1:] == times[:-1]) & (values[1:] == values[:-1])
+            return Envelope(times[~repeated], values[~repeated])
+        envelope = Envelope()
+        for i in sorted(range(len(self)), key=self.times.__getitem__):
+            time, value = self.times[i], self.values[i]
+            if envelope and envelope.times[-1] == time and envelope.values[-1] == value:
+                continue
+            envelope.times.append(time)
+            envelope.values.append(value)
+        return envelope
+
+    # Linear between points, held before the first and after the last one.
+    # Times have to be sorted.
+    def get_value(self, time):
+        if have_numpy:
+            return float(numpy.interp(time, self.times, self.values))
+        i = bisect.bisect_right(self.times, time)
+        if i == 0:
+            return self.values[0]
+        if i == len(self.times):
+            return self.values[-1]
+        t0, t1 = self.times[i - 1], self.times[i]
+        v0, v1 = self.values[i - 1], self.values[i]
+        return v0 + (v1 - v0) * (time - t0) / (t1 - t0)
+
+    # The part between start and end, moved to start at 0,
+    # with points added at both ends where the curve passes them.
+    def trim(self, start, end):
+        if not len(self):
+            return self
+        if have_numpy:
+            keep = (self.times > start) & (self.times < end)
+        else:
+            keep = [start < time < end for time in self.times]
+        inside = self.map_times(1.0, -start).select(keep)
+        return Envelope.join(
+            [[0.0], inside.times, [end - start]],
+            [[self.get_value(start)], inside.values, [self.get_value(end)]])
+
+    def select(self, keep):
+        if have_numpy:
+            keep = numpy.asarray(keep, dtype=bool)
+            return Envelope(self.times[keep], self.values[keep])
+        return Envelope(
+            [time for time, kept in zip(self.times, keep) if kept],
+            [value for value, kept in zip(self.values, keep) if kept])
+
+    def to_list(self):
+        return [{"time": time, "value": value} for time, value in zip(self.times.tolist(), self.values.tolist())]
+
+
+class TimelineItem:
+    __slots__ = ("source", "offset", "position", "duration",
+        "fadein", "fadeintype", "fadeout", "fadeouttype",
+        "volume", "playbackrate", "volume_envelope", "panning_envelope", "channel",
+        "mob_id", "slot_id")
+
+    def __init__(self, source=None, offset=None, position=None, duration=None):
+        self.source = source
+        self.offset = offset
+        self.position = position
+        self.duration = duration
+        self.fadein = None
+        self.fadeintype = None
+        self.fadeout = None
+        self.fadeouttype = None
+        self.volume = None
+        self.playbackrate = None
+        self.volume_envelope = None
+        self.panning_envelope = None
+        # Channel of a multichannel source to play, None plays all of them
+        self.channel = None
+        # Master mob slot the item plays, what re-conforming knows it by
+        self.mob_id = None
+        self.slot_id = None
+
+    def to_dict(self):
+        data = {}
+        for name in self.__slots__:
+            value = getattr(self, name)
+            if value is None: continue
+            data[name] = value.to_list() if isinstance(value, Envelope) else value
+        return data
+
+    def copy(self):
+        item = TimelineItem()
+        for name in self.__slots__:
+            setattr(item, name, getattr(self, name))
+        return item
+
+
+class TimelineTrack:
+    __slots__ = ("name", "items", "panning", "volume_envelope", "panning_envelope")
+
+    def __init__(self, name, items=None):
+        self.name = name
+        self.items = items
+        self.panning = None
+        self.volume_envelope = None
+        self.panning_envelope = None
+
+    def to_dict(self):
+        data = {"name": self.name}
+        if self.panning is not None:
+            data["panning"] = self.panning
+        if self.items is not None:
+            data["items"] = [item.to_dict() for item in self.items]
+        if self.volume_envelope is not None:
+            data["volume_envelope"] = self.volume_envelope.to_list()
+        if self.panning_envelope is not None:
+            data["panning_envelope"] = self.panning_envelope.to_list()
+        return data
+
+
+class Timeline:
+    __slots__ = ("tracks", "markers")
+
+    def __init__(self):
+        self.tracks = []
+        self.markers = []
+
+    def extend(self, timeline):
+        self.tracks += timeline.tracks
+        self.markers += timeline.markers
+
+    def to_dict(self):
+        return {
+            "tracks": [track.to_dict() for track in self.tracks],
+            "markers": self.markers
+        }
+
+
+
+# Everything extraction and parsing need to know about the mobs of a file,
+# gathered in one pass over the content storage.
+# Mobs are keyed by their mob ID as a string.
+class AAFIndex:
+
+    def __init__(self, interface):
+        # (master mob ID, slot ID) -> master mob slot and what it resolves to
+        self.master_slots = {}
+        self.source_mobs = {}
+        self.compositions = []
+        self.composition_mobs = {}
+        self.referenced = {}
+
+        master_mobs = []
+        for mob in interface.aaf.content.mobs:
+            if isinstance(mob, aaf2.mobs.MasterMob):
+                master_mobs.append(mob)
+            elif isinstance(mob, aaf2.mobs.SourceMob):
+                self.source_mobs[str(mob.mob_id)] = mob
+            elif isinstance(mob, aaf2.mobs.CompositionMob):
+                self.compositions.append(mob)
+                self.composition_mobs[str(mob.mob_id)] = mob
+
+        for master_mob in master_mobs:
+            master_id = str(master_mob.mob_id)
+            for slot in master_mob.slots:
+                entry = {
+                    "mob_name": master_mob.name,
+                    "slot_name": slot.name,
+                    "media_kind": slot.segment.media_kind,
+                    "source_id": None,
+                    "embedded": False,
+                    "format": None,
+                    "length": 0
+                }
+                self.master_slots[(master_id, slot.slot_id)] = entry
+
+                clip = self.get_source_clip(slot.segment)
+                if clip is None: continue
+                source_id = str(clip.mob_id)
+                source_mob = self.source_mobs.get(source_id, None)
+                if source_mob is None: continue
+
+                entry["source_id"] = source_id
+                entry["embedded"] = source_mob.essence is not None
+                try:
+                    entry["length"] = source_mob.descriptor["Length"].value or 0
+                    if entry["embedded"]:
+                        entry["format"] = interface.get_pcm_format(source_mob)
+                except Exception:
+                    pass
+
+    def get_source_clip(self, segment):
+        if isinstance(segment, aaf2.components.Sequence):
+            for component in segment.components:
+                if isinstance(component, aaf2.components.SourceClip):
+                    return component
+            return None
+        elif isinstance(segment, aaf2.components.SourceClip):
+            return segment
+        return None
+
+
+
+# Finds linked media by file name. Directory listings are read once and
+# kept, so thousands of linked files cost one listing per directory
+# instead of a stat call each. The search paths are only walked the first
+# time a file can't be found in its own directory or next to the AAF.
+class MediaIndex:
+
+    def __init__(self, search_paths):
+        self.search_paths = search_paths
+        self.listings = {}
+        self.files = None
+        self.found = {}
+
+    def get_listing(self, directory):
+        key = os.path.normcase(os.path.abspath(directory))
+        if key not in self.listings:
+            listing = {}
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_file():
+                            listing[os.path.normcase(entry.name)] = entry.name
+            except OSError:
+                pass
+            self.listings[key] = listing
+        return self.listings[key]
+
+    def get_file(self, directory, name):
+        name = self.get_listing(directory).get(os.path.normcase(name), None)
+        if name is None: return None
+        return os.path.join(directory, name)
+
+    def get_files(self):
+        if self.files is None:
+            self.files = {}
+            for search_path in self.search_paths:
+                for directory, _, names in os.walk(search_path):
+                    for name in names:
+                        self.files.setdefault(os.path.normcase(name), []).append(os.path.join(directory, name))
+        return self.files
+
+    # Of several files with the same name, the one whose parent
+    # directories match most of the original path wins.
+    def get_best_match(self, candidates, path):
+        def get_parts(candidate):
+            return os.path.normcase(candidate).replace("\\", "/").split("/")[::-1]
+        original = get_parts(path)
+        def score(candidate):
+            matching = 0
+            for a, b in zip(get_parts(candidate), original):
+                if a != b: break
+                matching += 1
+            return matching
+        return max(candidates, key=score)
+
+    # Returns path itself if the file is nowhere to be found
+    def find(self, path, aaf_directory):
+        if path in self.found:
+            return self.found[path]
+        name = os.path.basename(path)
+        found = self.get_file(os.path.dirname(path), name)
+        if found is None:
+            # Typically the source files are in the same directory as the AAF.
+            found = self.get_file(aaf_directory, name)
+        if found is None and self.search_paths:
+            candidates = self.get_files().get(os.path.normcase(name), None)
+            if candidates:
+                found = self.get_best_match(candidates, path)
+        self.found[path] = found or path
+        return self.found[path]
 
 
 
 class AAFInterface:
 
+    # Part of the timeline cache key, raised when parsed timelines
+    # gain or change fields so older entries aren't used.
+    timeline_version = 2
+
     def __init__(self):
-        self.aaf = None
+        self.aaf_file = None
+        self.index = None
+        self.nested_items = {}
+        self.media_index = None
+        self.progress = None
+        self.filename = ""
         self.encoder = ""
         self.aaf_directory = ""
         self.essence_data = {}
+        self.essence_segments = {}
+        self.essence_channels = {}
+        self.cache = None
+        self.cache_key = None
+        self.cache_entry = None
+        self.essence_key = None
+
+    # With a timeline cache the file is only opened once something
+    # has to be read from it that the cache doesn't have.
+    def open(self, filename, cache=None):
+        self.aaf_file = None
+        self.filename = os.path.abspath(filename)
+        self.aaf_directory = os.path.dirname(self.filename)
+        self.index = None
+        self.nested_items = {}
+        self.media_index = None
+        self.essence_data = {}
+        self.essence_segments = {}
+        self.essence_channels = {}
+        self.cache = cache
+        self.cache_entry = None
+        self.essence_key = None
+
+        if cache:
+            try:
+                self.cache_key = cache.get_key(filename)
+                self.cache_entry = cache.load(self.cache_key)
+            except OSError:
+                self.cache = None
+        if self.cache_entry:
+            self.encoder = self.cache_entry["encoder"]
+            return True
 
-    def open(self, filename):
         try:
-            self.aaf = aaf2.open(filename, "r")
+            self.aaf_file = aaf2.open(filename, "r")
         except Exception:
             log("Could not open AAF file.", ERROR)
             return False
@@ -173,31 +1691,135 @@ class AAFInterface:
             self.encoder = self.aaf.header["IdentificationList"][0]["ProductName"].value
         except Exception:
             log("Unable to find file encoder", WARNING)
-        self.aaf_directory = os.path.abspath(os.path.dirname(filename))
-        self.essence_data = {}
+        self.cache_entry = {
+            "encoder": self.encoder,
+            "essence": {},
+            "compositions": {}
+        }
         return True
 
-    def build_wav(self, fname, data, depth=16, rate=48000, channels=1):
-        with wave.open(fname, "wb") as f:
-            f.setnchannels(channels)
-            f.setsampwidth(int(depth / 8))
-            f.setframerate(rate)
-            f.writeframesraw(data)
-            f.close()
+    @property
+    def aaf(self):
+        if self.aaf_file is None:
+            self.aaf_file = aaf2.open(self.filename, "r")
+        return self.aaf_file
+
+    def save_cache(self):
+        if self.cache and self.cache_entry:
+            self.cache.store(self.cache_key, self.cache_entry)
+
+    # Every setting that changes which files essence is extracted to,
+    # cached essence mappings are only used when all of them match.
+    def get_essence_key(self, target, composition):
+        return json.dumps([os.path.abspath(target), composition,
+            extract_unused_essence, consolidate, consolidate_handles, media_search_paths,
+            interleave_channels])
+
+    # Restores the essence mapping of an earlier import into the same
+    # directory, if all the files it points to are still there. If one
+    # is gone, extracted or linked, the mapping and the timelines built
+    # on it are dropped. Linked media that was offline already is looked
+    # for again only then.
+    def load_cached_essence(self, target, composition):
+        self.essence_key = self.get_essence_key(target, composition)
+        if not self.cache: return False
+        cached = self.cache_entry["essence"].get(self.essence_key, None)
+        if not cached: return False
+
+        missing = set(cached.get("missing", []))
+        for filename in self.get_essence_files(cached["essence_data"], cached["essence_segments"]):
+            if filename not in missing and not os.path.isfile(filename):
+                log("%s is missing, reading essence again." % filename)
+                self.invalidate_essence(self.essence_key)
+                return False
+
+        self.essence_data = {
+            mob_id: {int(slot_id): filename for slot_id, filename in slots.items()}
+            for mob_id, slots in cached["essence_data"].items()
+        }
+        self.essence_segments = {
+            filename: [tuple(segment) for segment in segments]
+            for filename, segments in cached["essence_segments"].items()
+        }
+        self.essence_channels = {
+            mob_id: {int(slot_id): channel for slot_id, channel in slots.items()}
+            for mob_id, slots in cached.get("essence_channels", {}).items()
+        }
+        return True
+
+    def invalidate_essence(self, essence_key):
+        del self.cache_entry["essence"][essence_key]
+        compositions = self.cache_entry["compositions"]
+        for key in list(compositions):
+            if json.loads(key)[2] == essence_key:
+                del compositions[key]
+
+    def get_essence_files(self, essence_data, essence_segments):
+        for slots in essence_data.values():
+            for filename in slots.values():
+                if filename and filename not in essence_segments:
+                    yield filename
+        for segments in essence_segments.values():
+            for segment in segments:
+                yield segment[2]
+
+    # The index is built the first time something needs it.
+    def get_index(self):
+        if self.index is None:
+            with profiler.phase("index"):
+                self.index = AAFIndex(self)
+            profiler.count("master_mob_slots", len(self.index.master_slots))
+            profiler.count("source_mobs", len(self.index.source_mobs))
+            profiler.count("composition_mobs", len(self.index.compositions))
+        return self.index
+
+    def copy_stream(self, stream, f, size=None, peaks=None):
+        while size is None or size > 0:
+            chunk_size = essence_chunk_size if size is None else min(size, essence_chunk_size)
+            data = stream.read(chunk_size)
+            if not data: break
+            f.write(data)
+            if peaks:
+                peaks.add(data)
+            if size is not None:
+                size -= len(data)
+            if self.progress:
+                self.progress.advance(len(data))
+
+    def build_wav(self, fname, stream, depth=16, rate=48000, channels=1, size=None):
+        peaks = None
+        if write_peak_files and have_numpy and depth in [8, 16, 24, 32]:
+            peaks = PeakBuilder(depth, rate, channels)
+        try:
+            with WavWriter(fname, depth, rate, channels) as f:
+                self.copy_stream(stream, f, size, peaks)
+            if peaks:
+                try:
+                    peaks.write(fname + ".reapeaks", fname)
+                except OSError:
+                    log("Could not write peak file for %s" % fname, WARNING)
+        finally:
+            if peaks:
+                peaks.close()
 
     def aafrational_value(self, rational):
         return rational.numerator / rational.denominator
 
     def get_point_list(self, varying, duration):
-        data = []
-        for point in varying["PointList"]:
-            data.append({
-                "time": point.time * duration,
-                "value": point.value
-            })
-        return data
+        # Every pass over the PointList decodes its objects again
+        points = list(varying["PointList"])
+        envelope = Envelope([point.time for point in points], [point.value for point in points])
+        return envelope.map_times(duration)
+
+    # REAPER pans the other way round
+    def invert_panning(self, envelope):
+        return envelope.map_values(-2, 1)
 
     def get_linked_essence(self, mob):
+        with profiler.phase("linked_essence"):
+            return self.find_linked_essence(mob)
+
+    def find_linked_essence(self, mob):
         try:
             url = mob.descriptor.locator.pop()["URLString"].value
             # file:///C%3a/Users/user/My%20video.mp4
@@ -211,126 +1833,539 @@ class AAFInterface:
 
             # If the AAF was built on another computer,
             # chances are the paths will differ.
-            # Typically the source files are in the same directory as the AAF.
-            if not os.path.isfile(url):
-                local = os.path.join(self.aaf_directory, os.path.basename(url))
-                if os.path.isfile(local):
-                    url = local
-            return url
+            if self.media_index is None:
+                self.media_index = MediaIndex(media_search_paths)
+            return self.media_index.find(url, self.aaf_directory)
 
         except Exception:
             log("Error retrieving file url for %s" % mob.name, WARNING)
             return ""
 
-    def extract_embedded_essence(self, mob, filename):
+    # Returns the sample format of MXF wrapped PCM essence,
+    # or None for anything we just copy.
+    def get_pcm_format(self, mob):
+        meta = mob.descriptor
+        data_fmt = meta["ContainerFormat"].value.name if "ContainerFormat" in meta else ""
+        if data_fmt != "MXF": return None
+        return {
+            "depth": meta["QuantizationBits"].value,
+            "rate": self.aafrational_value(meta["SampleRate"].value),
+            "channels": meta["Channels"].value if "Channels" in meta else 1
+        }
+
+    # sample_range is a (first, last) pair of sample frames to extract
+    # instead of the whole essence, only used for PCM essence.
+    def extract_embedded_essence(self, mob, filename, sample_range=None):
         log("Extracting essence %s..." % filename)
         stream = mob.essence.open()
-        data = stream.read()
-        stream.close()
 
-        meta = mob.descriptor
-        data_fmt = meta["ContainerFormat"].value.name if "ContainerFormat" in meta else ""
-        if data_fmt == "MXF":
-            sample_depth = meta["QuantizationBits"].value
-            sample_rate = meta["SampleRate"].value
-            sample_rate = self.aafrational_value(sample_rate)
-            self.build_wav(filename, data, sample_depth, sample_rate)
-        else:
-            with open(filename, "wb") as f:
-                f.write(data)
-                f.close()
+        pcm_format = self.get_pcm_format(mob)
+        try:
+            if pcm_format:
+                size = None
+                if sample_range:
+                    block_align = pcm_format["channels"] * int(pcm_format["depth"] / 8)
+                    stream.seek(sample_range[0] * block_align)
+                    size = (sample_range[1] - sample_range[0]) * block_align
+                self.build_wav(filename, stream, pcm_format["depth"], pcm_format["rate"],
+                    pcm_format["channels"], size)
+            else:
+                with open(filename, "wb") as f:
+                    self.copy_stream(stream, f)
+        except BaseException:
+            # Don't leave half written files behind, e.g. when cancelled
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            raise
+        finally:
+            stream.close()
 
         return filename
 
-    def extract_essence(self, target, callback):
-        for master_mob in self.aaf.content.mastermobs():
-            self.essence_data[master_mob.name] = {}
-            for slot in master_mob.slots:
+    def extract_job(self, job):
+        if "source_ids" in job:
+            return self.extract_interleaved_essence(job)
+        # Workers don't need the whole index for this
+        source_mob = self.aaf.content.mobs.get(aaf2.mobid.MobID(job["source_id"]))
+        return self.extract_embedded_essence(source_mob, job["filename"], job.get("sample_range", None))
 
-                if isinstance(slot.segment, aaf2.components.Sequence):
-                    source_mob = None
-                    for component in slot.segment.components:
-                        if isinstance(component, aaf2.components.SourceClip):
-                            source_mob = component.mob
-                            break
-                    else:
-                        self.essence_data[master_mob.name][slot.slot_id] = ""
-                        log("Cannot find essence for %s slot %d" % (master_mob.name, slot.slot_id), WARNING)
-                elif isinstance(slot.segment, aaf2.components.SourceClip):
-                    source_mob = slot.segment.mob
-
-                if slot.segment.media_kind == "Picture":
-                    # Video files cannot be embedded in the AAF.
-                    self.essence_data[master_mob.name][slot.slot_id] = self.get_linked_essence(source_mob)
+    def extract_interleaved_essence(self, job):
+        filename = job["filename"]
+        log("Extracting essence %s..." % filename)
+        mobs = [self.aaf.content.mobs.get(aaf2.mobid.MobID(source_id)) for source_id in job["source_ids"]]
+        pcm_format = self.get_pcm_format(mobs[0])
+
+        streams = []
+        try:
+            for mob in mobs:
+                streams.append(mob.essence.open())
+            stream = InterleavedStream(streams, int(pcm_format["depth"] / 8))
+            self.build_wav(filename, stream, pcm_format["depth"], pcm_format["rate"], len(streams))
+        except BaseException:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            raise
+        finally:
+            for stream in streams:
+                stream.close()
+
+        return filename
+
+    def finish_job(self, job, filename, cache):
+        if "segment_of" in job:
+            start, end = job["segment"]
+            self.essence_segments[job["segment_of"]].append((start, end, filename))
+        else:
+            for mob_id, slot_id in job["targets"]:
+                self.essence_data[mob_id][slot_id] = filename
+        if cache:
+            cache.store(job["key"], filename)
+
+    # Merges the used (start, end) ranges of a source, in seconds,
+    # into the sample ranges to extract.
+    def get_consolidated_ranges(self, ranges, rate, length):
+        merged = []
+        for start, end in sorted(ranges):
+            start = max(int((start - consolidate_handles) * rate), 0)
+            end = min(int((end + consolidate_handles) * rate + 1), length)
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        return merged
+
+    # Splits the job of a consolidated source into one job per used range.
+    # The slots keep pointing at the job's filename, which is never written.
+    # Items are moved to the trimmed files by apply_essence_segments.
+    def get_segment_jobs(self, job, source_mob):
+        pcm_format = self.get_pcm_format(source_mob)
+        if not pcm_format or not job["ranges"]:
+            return [job]
+
+        block_align = pcm_format["channels"] * int(pcm_format["depth"] / 8)
+        stream = source_mob.essence.open()
+        try:
+            length = stream.seek(0, os.SEEK_END) // block_align
+        finally:
+            stream.close()
+
+        for mob_id, slot_id in job["targets"]:
+            self.essence_data[mob_id][slot_id] = job["filename"]
+        self.essence_segments[job["filename"]] = []
+
+        rate = pcm_format["rate"]
+        name = os.path.splitext(job["filename"])[0]
+        segment_jobs = []
+        for start, end in self.get_consolidated_ranges(job["ranges"], rate, length):
+            segment_jobs.append({
+                "source_id": job["source_id"],
+                "segment_of": job["filename"],
+                "segment": (start / rate, end / rate),
+                "sample_range": (start, end),
+                "filename": "%s_%d.wav" % (name, start),
+                "size": (end - start) * block_align
+            })
+        return segment_jobs
+
+    # Points items of consolidated sources at the trimmed file
+    # that holds them, and shifts their offsets to match.
+    def apply_essence_segments(self, timeline):
+        for track in timeline.tracks:
+            for item in track.items or []:
+                segments = self.essence_segments.get(item.source, None)
+                if not segments: continue
+                for start, end, filename in segments:
+                    if start <= item.offset < end:
+                        item.source = filename
+                        item.offset -= start
+                        break
+                else:
+                    log("No consolidated media for item at %f seconds." % item.position, WARNING)
+        return timeline
+
+    def extract_jobs_parallel(self, jobs, callback, cache):
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=min(extraction_workers, len(jobs)),
+            mp_context=get_worker_context(),
+            initializer=extraction_worker_init,
+            initargs=(self.filename,)
+        ) as pool:
+            futures = {pool.submit(extraction_worker_run, job): job for job in jobs}
+            for future in concurrent.futures.as_completed(futures):
+                job = futures[future]
+                filename = future.result()
+                profiler.count_file(filename)
+                self.finish_job(job, filename, cache)
+                if callback:
+                    callback("Extracted %s" % os.path.basename(job["filename"]))
+                # Workers report whole files only, jobs already running
+                # are finished when cancelling.
+                if self.progress:
+                    try:
+                        self.progress.advance(job["size"])
+                    except ExtractionCancelled:
+                        pool.shutdown(cancel_futures=True)
+                        raise
+
+    # Maps the (master mob ID, slot ID) pairs reachable from a composition
+    # to the (start, end) ranges of them that are used, in seconds.
+    def get_referenced_essence(self, composition):
+        index = self.get_index()
+        if composition in index.referenced:
+            return index.referenced[composition]
+        referenced = index.referenced[composition] = {}
+        mob = index.compositions[composition]
+        segments = [(slot.segment, self.aafrational_value(slot.edit_rate)) for slot in mob.slots]
+        # Nested composition slots are walked once, however often they are
+        # used, and as a whole rather than just the parts the clips cover.
+        nested = set((str(mob.mob_id), slot.slot_id) for slot in mob.slots)
+        while segments:
+            segment, edit_rate = segments.pop()
+            if isinstance(segment, aaf2.components.SourceClip) and str(segment.mob_id) in index.composition_mobs:
+                key = (str(segment.mob_id), segment.slot_id)
+                if key in nested: continue
+                nested.add(key)
+                try:
+                    slot = index.composition_mobs[key[0]].slot_at(segment.slot_id)
+                except IndexError:
+                    continue
+                segments.append((slot.segment, self.aafrational_value(slot.edit_rate)))
+            elif isinstance(segment, aaf2.components.SourceClip):
+                start = segment.start / edit_rate
+                ranges = referenced.setdefault((str(segment.mob_id), segment.slot_id), [])
+                ranges.append((start, start + segment.length / edit_rate))
+            elif isinstance(segment, aaf2.components.Sequence):
+                segments.extend((component, edit_rate) for component in segment.components)
+            elif isinstance(segment, aaf2.components.OperationGroup):
+                segments.extend((input_segment, edit_rate) for input_segment in segment.segments)
+            elif isinstance(segment, aaf2.components.NestedScope):
+                segments.extend((nested, edit_rate) for nested in segment.slots.value)
+        return referenced
+
+    def extract_essence(self, target, callback, composition=None):
+        referenced = None
+        if composition is not None and not extract_unused_essence:
+            referenced = self.get_referenced_essence(composition)
+        cache = EssenceCache(target) if use_essence_cache else None
+        try:
+            self.extract_essence_to(target, callback, cache, referenced)
+        finally:
+            if cache:
+                cache.save()
+
+        self.essence_key = self.get_essence_key(target, composition)
+        if self.cache:
+            files = self.get_essence_files(self.essence_data, self.essence_segments)
+            self.cache_entry["essence"][self.essence_key] = {
+                "essence_data": self.essence_data,
+                "essence_segments": self.essence_segments,
+                "essence_channels": self.essence_channels,
+                "missing": sorted(set(filename for filename in files if not os.path.isfile(filename)))
+            }
+
+    def extract_essence_to(self, target, callback, cache, referenced):
+        index = self.get_index()
+
+        # Several master mobs (subclips, duplicates) can share one source mob.
+        # Each source is extracted once and every slot pointing to it
+        # gets the same file.
+        jobs = {}
+        linked = {}
+        interleaved = {}
+        if interleave_channels and not consolidate:
+            for job in self.get_interleaved_jobs(target, referenced):
+                jobs[tuple(job["source_ids"])] = job
+                for channel, source_id in enumerate(job["source_ids"]):
+                    interleaved[source_id] = (job, channel)
+
+        for (master_id, slot_id), entry in index.master_slots.items():
+            if referenced is not None and (master_id, slot_id) not in referenced:
+                continue
+            essence = self.essence_data.setdefault(master_id, {})
+            source_id = entry["source_id"]
+            if source_id is None:
+                log("Cannot find essence for %s slot %d" % (entry["mob_name"], slot_id), WARNING)
+                essence[slot_id] = ""
+                continue
+
+            if source_id in interleaved:
+                job, channel = interleaved[source_id]
+                job["targets"].append((master_id, slot_id))
+                self.essence_channels.setdefault(master_id, {})[slot_id] = channel
+                continue
+            if source_id in jobs:
+                jobs[source_id]["targets"].append((master_id, slot_id))
+                if referenced:
+                    jobs[source_id]["ranges"] += referenced[(master_id, slot_id)]
+                continue
+            if source_id in linked:
+                essence[slot_id] = linked[source_id]
+                continue
+
+            # Video files cannot be embedded in the AAF.
+            if entry["media_kind"] == "Picture" or not entry["embedded"]:
+                linked[source_id] = self.get_linked_essence(index.source_mobs[source_id])
+                essence[slot_id] = linked[source_id]
+                continue
+
+            jobs[source_id] = {
+                "source_id": source_id,
+                "targets": [(master_id, slot_id)],
+                "ranges": list(referenced[(master_id, slot_id)]) if referenced else [],
+                "name": entry["mob_name"] + entry["slot_name"],
+                "size": self.get_essence_size(entry)
+            }
+
+        pending = []
+        claimed = []
+        for job in jobs.values():
+            source_mob = index.source_mobs[job["source_id"]]
+            key = None
+            if cache:
+                key = "|".join(cache.get_key(index.source_mobs[source_id])
+                    for source_id in job.get("source_ids", [job["source_id"]]))
+            # Mob names aren't unique, not even within one file. Files are told
+            # apart by their source mobs, or by their content when several
+            # files share the media directory.
+            identity = key if cache and shared_media else "|".join(job.get("source_ids", [job["source_id"]]))
+            job["filename"] = os.path.join(target, "%s_%s.wav" % (
+                safe_filename(job["name"]), hashlib.sha1(identity.encode()).hexdigest()[:8]))
+            segment_jobs = [job]
+            if consolidate and referenced is not None:
+                segment_jobs = self.get_segment_jobs(job, source_mob)
+            for segment_job in segment_jobs:
+                if not cache:
+                    pending.append(segment_job)
                     continue
-                if source_mob.essence:
-                    filename = os.path.join(target, master_mob.name + slot.name + ".wav")
+                segment_job["key"] = key
+                if "sample_range" in segment_job:
+                    segment_job["key"] += ":%d-%d" % segment_job["sample_range"]
+                cached = cache.lookup(segment_job["key"])
+                if not cached and shared_media:
+                    if not cache.claim(segment_job["key"]):
+                        claimed.append(segment_job)
+                        continue
+                    cache.reload()
+                    cached = cache.lookup(segment_job["key"])
+                    if cached:
+                        cache.release(segment_job["key"])
+                if cached:
+                    self.finish_job(segment_job, cached, None)
                     if callback:
-                        callback("Extracting %s..." % (master_mob.name + slot.name + ".wav"))
-                    self.essence_data[master_mob.name][slot.slot_id] = self.extract_embedded_essence(source_mob, filename)
+                        callback("Using existing %s" % os.path.basename(cached))
                 else:
-                    self.essence_data[master_mob.name][slot.slot_id] = self.get_linked_essence(source_mob)
+                    pending.append(segment_job)
+
+        if self.progress:
+            self.progress.set_total(sum(job["size"] for job in pending))
+        try:
+            self.run_jobs(pending, callback, cache)
+        finally:
+            if cache:
+                cache.release_claims()
+
+        # Essence claimed by other imports is used once they are done with it,
+        # or extracted here if they failed.
+        for job in claimed:
+            while True:
+                cached = cache.wait(job["key"])
+                if cached:
+                    self.finish_job(job, cached, None)
+                    break
+                if cache.claim(job["key"]):
+                    try:
+                        self.run_jobs([job], callback, cache)
+                    finally:
+                        cache.release_claims()
+                    break
+
+    # Groups the mono PCM slots of each master mob that share a sample
+    # format into jobs writing them to one file, a channel per slot.
+    # A source already in a group, e.g. when subclips share it, isn't
+    # grouped again but uses the channel it has there.
+    def get_interleaved_jobs(self, target, referenced):
+        masters = {}
+        for (master_id, slot_id), entry in self.get_index().master_slots.items():
+            if referenced is not None and (master_id, slot_id) not in referenced:
+                continue
+            pcm_format = entry["format"]
+            if entry["media_kind"] != "Sound" or not entry["embedded"] or not pcm_format:
+                continue
+            if pcm_format["channels"] != 1:
+                continue
+            masters.setdefault(master_id, []).append((slot_id, entry))
+
+        jobs = []
+        grouped = set()
+        for master_id, slots in masters.items():
+            groups = {}
+            for slot_id, entry in sorted(slots, key=lambda slot: slot[0]):
+                if entry["source_id"] in grouped: continue
+                pcm_format = entry["format"]
+                group = groups.setdefault((pcm_format["depth"], pcm_format["rate"]), [])
+                if entry["source_id"] not in [other["source_id"] for other in group]:
+                    group.append(entry)
+
+            files = 0
+            for (depth, rate), entries in groups.items():
+                if len(entries) < 2: continue
+                source_ids = [entry["source_id"] for entry in entries]
+                grouped.update(source_ids)
+                # Formats that can't share a file get one each
+                name = entries[0]["mob_name"] + ("_%d" % files if files else "")
+                files += 1
+                jobs.append({
+                    "source_id": source_ids[0],
+                    "source_ids": source_ids,
+                    "targets": [],
+                    "ranges": [],
+                    "name": name,
+                    "size": max(entry["length"] for entry in entries) * len(entries) * int(depth / 8)
+                })
+        return jobs
+
+    def run_jobs(self, jobs, callback, cache):
+        if extraction_workers > 1 and len(jobs) > 1:
+            if have_reaper and not worker_python:
+                log("Set worker_python to extract essence in parallel inside REAPER.", WARNING)
+            else:
+                try:
+                    self.extract_jobs_parallel(jobs, callback, cache)
+                    return
+                except (OSError, concurrent.futures.process.BrokenProcessPool):
+                    log("Could not start extraction workers, extracting serially.", WARNING)
+
+        for job in jobs:
+            if callback:
+                callback("Extracting %s..." % os.path.basename(job["filename"]))
+            filename = self.extract_job(job)
+            profiler.count_file(filename)
+            self.finish_job(job, filename, cache)
+
+    # In bytes as extracted. Essence that is copied as it is, or whose
+    # length the index doesn't know, is measured on its stream.
+    def get_essence_size(self, entry):
+        pcm_format = entry["format"]
+        if pcm_format and entry["length"]:
+            return entry["length"] * pcm_format["channels"] * int(pcm_format["depth"] / 8)
+        stream = self.get_index().source_mobs[entry["source_id"]].essence.open()
+        try:
+            return stream.seek(0, os.SEEK_END)
+        finally:
+            stream.close()
 
-    def get_essence_file(self, mob_name, slot_id):
+    def get_essence_file(self, mob_id, slot_id):
         try:
-            return self.essence_data[mob_name][slot_id]
+            return self.essence_data[mob_id][slot_id]
         except Exception:
-            log("Cannot find essence for %s slot %d" % (mob_name, slot_id), WARNING)
+            entry = self.get_index().master_slots.get((mob_id, slot_id), None)
+            log("Cannot find essence for %s slot %d" % (entry["mob_name"] if entry else mob_id, slot_id), WARNING)
             return ""
 
-    def get_embedded_essence_count(self):
-        count = 0
-        for master_mob in self.aaf.content.mastermobs():
-            for slot in master_mob.slots:
-                if isinstance(slot.segment, aaf2.components.Sequence):
-                    source_mob = None
-                    for component in slot.segment.components:
-                        if isinstance(component, aaf2.components.SourceClip):
-                            source_mob = component.mob
-                            break
-                    else:
-                        continue
-                elif isinstance(slot.segment, aaf2.components.SourceClip):
-                    source_mob = slot.segment.mob
-                if slot.segment.media_kind == "Sound" and source_mob.essence:
-                    count += 1
-        return count
-
+    # Channel of the slot in an interleaved file, None if it has a file of its own
+    def get_essence_channel(self, mob_id, slot_id):
+        return self.essence_channels.get(mob_id, {}).get(slot_id, None)
+
+
+    def amplitude_to_db(self, value):
+        if have_numpy:
+            return 20 * numpy.log10(numpy.maximum(value, 1e-8))
+        return 20 * math.log10(max(value, 1e-8))
+
+    # Douglas-Peucker on the value axis: a point is kept if leaving it out
+    # would move the line between its neighbours by more than the tolerance.
+    # The line is drawn between the values as REAPER interpolates them,
+    # scale only converts the difference to the unit of the tolerance,
+    # e.g. amplitude to dB.
+    def simplify_envelope(self, envelope, tolerance, scale=None):
+        envelope = envelope.get_sorted()
+        if len(envelope) < 3:
+            return envelope
+
+        times = envelope.times
+        values = envelope.values
+        scaled = values
+        if scale:
+            scaled = scale(values) if have_numpy else [scale(value) for value in values]
+        tolerance += 1e-9
+
+        keep = [False] * len(times)
+        keep[0] = keep[-1] = True
+        stack = [(0, len(times) - 1)]
+        while stack:
+            first, last = stack.pop()
+            if last - first < 2: continue
+            t0, v0 = times[first], values[first]
+            span = times[last] - t0
+            slope = (values[last] - v0) / span if span else 0.0
+            if have_numpy:
+                if span:
+                    expected = v0 + slope * (times[first + 1:last] - t0)
+                else:
+                    expected = values[last]
+                if scale:
+                    expected = scale(expected)
+                errors = numpy.abs(scaled[first + 1:last] - expected)
+                worst = int(numpy.argmax(errors))
+                worst_error = errors[worst]
+                worst += first + 1
+            else:
+                worst = None
+                worst_error = 0.0
+                for i in range(first + 1, last):
+                    expected = v0 + slope * (times[i] - t0) if span else values[last]
+                    if scale:
+                        expected = scale(expected)
+                    error = abs(scaled[i] - expected)
+                    if error > worst_error:
+                        worst = i
+                        worst_error = error
+            if worst_error > tolerance:
+                keep[worst] = True
+                stack.append((first, worst))
+                stack.append((worst, last))
+
+        return envelope.select(keep)
 
     # Instead of using per-item volume curves (aka take volume envelope),
     # we collect data from items and "render" it to the track volume envelope.
     def collect_vol_pan_automation(self, track):
-        envelopes = {
-            "volume_envelope": [],
-            "panning_envelope": []
-        }
-        for envelope in envelopes:
-            for item in track["items"]:
-                if envelope in item:
-                    for point in item[envelope]:
-                        envelopes[envelope].append({
-                            "time": item["position"] + point["time"],
-                            "value": point["value"]
-                        })
-                    del item[envelope]
+        for name in ["volume_envelope", "panning_envelope"]:
+            times = []
+            values = []
+            for item in track.items:
+                envelope = getattr(item, name)
+                if envelope is not None:
+                    envelope = envelope.map_times(1.0, item.position)
+                    times.append(envelope.times)
+                    values.append(envelope.values)
+                    setattr(item, name, None)
                 else:
-                    if not envelopes[envelope]: continue
+                    if not times: continue
                     # We don't want items without automation to be affected
                     # by automation added by other items
-                    envelopes[envelope].append({
-                        "time": item["position"],
-                        "value": 1.0
-                    })
-                    envelopes[envelope].append({
-                        "time": item["position"] + item["duration"],
-                        "value": 1.0
-                    })
-
-        # Add only if not empty
-        if envelopes["volume_envelope"]:
-            track["volume_envelope"] = envelopes["volume_envelope"]
-        if envelopes["panning_envelope"]:
-            track["panning_envelope"] = envelopes["panning_envelope"]
+                    times.append((item.position, item.position + item.duration))
+                    values.append((1.0, 1.0))
+
+            # Add only if not empty
+            if times:
+                setattr(track, name, Envelope.join(times, values))
+
+        if profiler.enabled:
+            for envelope in [track.volume_envelope, track.panning_envelope]:
+                if envelope is not None:
+                    profiler.count("envelope_points", len(envelope))
+
+        if track.volume_envelope is not None:
+            track.volume_envelope = self.simplify_envelope(
+                track.volume_envelope, volume_envelope_tolerance, self.amplitude_to_db)
+        if track.panning_envelope is not None:
+            track.panning_envelope = self.simplify_envelope(
+                track.panning_envelope, panning_envelope_tolerance)
 
         return track
 
@@ -338,9 +2373,9 @@ class AAFInterface:
     # It is supposed to gather whatever information it can and pass it to
     # its caller, who will append the new data to its own.
     # The topmost caller sets "position" and "duration", as well as fades,
-    def parse_operation_group(self, group, edit_rate):
-
-        item = {}
+    # nested groups fill in the same item and override what outer ones set.
+    # Returns the SourceClip the groups end at, if any.
+    def parse_operation_group(self, group, edit_rate, item):
 
         # We could base volume envelope extraction on either group.operation.name
         # or group.parameters[].name depending on which is more prone to be constant.
@@ -350,18 +2385,15 @@ class AAFInterface:
             for p in group.parameters:
                 if p.name not in ["Amplitude", "Amplitude multiplier", "Level"]: continue
                 if isinstance(p, aaf2.misc.VaryingValue):
-                    item["volume_envelope"] = self.get_point_list(p, group.length / edit_rate)
+                    item.volume_envelope = self.get_point_list(p, group.length / edit_rate)
                 elif isinstance(p, aaf2.misc.ConstantValue):
-                    item["volume"] = self.aafrational_value(p.value)
+                    item.volume = self.aafrational_value(p.value)
 
         if group.operation.name == "Mono Audio Pan":
             for p in group.parameters:
                 points = self.get_point_list(p, group.length / edit_rate)
                 if p.name == "Pan value":
-                    item["panning_envelope"] = [{
-                        "time": point["time"],
-                        "value": point["value"] * -2 + 1
-                    } for point in points]
+                    item.panning_envelope = self.invert_panning(points)
 
         if group.operation.name == "Audio Effect":
             for p in group.parameters:
@@ -371,7 +2403,7 @@ class AAFInterface:
                     # since the parameter name is blank.
                     pass
                 if p.name == "SpeedRatio":
-                    item["playbackrate"] = self.aafrational_value(p.value)
+                    item.playbackrate = self.aafrational_value(p.value)
 
         segment = group.segments[0]
 
@@ -380,16 +2412,21 @@ class AAFInterface:
             segment = segment.components[0]
 
         if isinstance(segment, aaf2.components.OperationGroup):
-            item.update(self.parse_operation_group(segment, edit_rate))
+            return self.parse_operation_group(segment, edit_rate, item)
         elif isinstance(segment, aaf2.components.SourceClip):
-            item.update({
-                "source": self.get_essence_file(segment.mob.name, segment.slot_id),
-                "offset": segment.start / edit_rate,
-            })
-
-        return item
+            # Nested compositions are flattened by the caller
+            if not self.is_composition_clip(segment):
+                item.source = self.get_essence_file(str(segment.mob_id), segment.slot_id)
+                item.channel = self.get_essence_channel(str(segment.mob_id), segment.slot_id)
+                item.mob_id = str(segment.mob_id)
+                item.slot_id = segment.slot_id
+            item.offset = segment.start / edit_rate
+            return segment
+        return None
 
     def parse_sequence(self, sequence, edit_rate):
+        if profiler.enabled:
+            profiler.count("components", len(sequence.components))
         items = []
         time = 0.0
         fade = 0  # 0 = no fade, 1 = fade, -1 = last component was filler
@@ -401,38 +2438,42 @@ class AAFInterface:
                 duration = component.length / edit_rate
 
                 if isinstance(component, aaf2.components.SourceClip):
-                    item = {
-                        "source": self.get_essence_file(component.mob.name, component.slot_id),
-                        "offset": component.start / edit_rate,
-                        "position": time,
-                        "duration": duration,
-                    }
-                    if fade == 1:
-                        item["fadein"] = fade_length
-                        item["fadeintype"] = fade_type
+                    if self.is_composition_clip(component):
+                        item = TimelineItem(offset=component.start / edit_rate, position=time, duration=duration)
+                        clip_items = self.get_nested_items(component, edit_rate, item)
+                    else:
+                        item = TimelineItem(
+                            self.get_essence_file(str(component.mob_id), component.slot_id),
+                            component.start / edit_rate, time, duration)
+                        item.channel = self.get_essence_channel(str(component.mob_id), component.slot_id)
+                        item.mob_id = str(component.mob_id)
+                        item.slot_id = component.slot_id
+                        clip_items = [item]
+                    if fade == 1 and clip_items:
+                        clip_items[0].fadein = fade_length
+                        clip_items[0].fadeintype = fade_type
                     fade = 0
-                    items.append(item)
+                    items += clip_items
                     time += duration
 
                 elif isinstance(component, aaf2.components.OperationGroup):
-                    item = {
-                        "position": time,
-                        "duration": duration
-                    }
-                    item.update(self.parse_operation_group(component, edit_rate))
-                    if fade == 1:
-                        item["fadein"] = fade_length
-                        item["fadeintype"] = fade_type
+                    item = TimelineItem(position=time, duration=duration)
+                    clip = self.parse_operation_group(component, edit_rate, item)
+                    if clip is not None and self.is_composition_clip(clip):
+                        clip_items = self.get_nested_items(clip, edit_rate, item)
+                    else:
+                        if item.source is None:
+                            log("Failed to find item source at %f seconds." % time, WARNING)
+                            item.source = ""
+                        if item.offset is None:
+                            log("Failed to find item offset at %f seconds." % time, WARNING)
+                            item.offset = 0
+                        clip_items = [item]
+                    if fade == 1 and clip_items:
+                        clip_items[0].fadein = fade_length
+                        clip_items[0].fadeintype = fade_type
                     fade = 0
-
-                    if "source" not in item:
-                        log("Failed to find item source at %f seconds." % time, WARNING)
-                        item["source"] = ""
-                    if "offset" not in item:
-                        log("Failed to find item offset at %f seconds." % time, WARNING)
-                        item["offset"] = 0
-
-                    items.append(item)
+                    items += clip_items
                     time += duration
 
                 elif isinstance(component, aaf2.components.Transition):
@@ -444,8 +2485,8 @@ class AAFInterface:
                     except Exception:
                         pass
                     if fade == 0:
-                        items[-1]["fadeout"] = fade_length
-                        items[-1]["fadeouttype"] = fade_type
+                        items[-1].fadeout = fade_length
+                        items[-1].fadeouttype = fade_type
                     if fade != 1:
                         fade = 1
                     time -= duration
@@ -459,6 +2500,67 @@ class AAFInterface:
 
         return items
 
+    def is_composition_clip(self, clip):
+        mob_id = str(clip.mob_id)
+        if mob_id in self.essence_data:
+            return False
+        return mob_id in self.get_index().composition_mobs
+
+    # Items of a composition slot used inside other compositions, parsed
+    # once however often it is used. Times are in seconds, so the result
+    # doesn't depend on the edit rate of the compositions using it.
+    def get_nested_timeline(self, mob_id, slot_id):
+        key = (mob_id, slot_id)
+        if key in self.nested_items:
+            return self.nested_items[key]
+        # Empty while it is parsed, in case it ends up containing itself
+        self.nested_items[key] = []
+        try:
+            slot = self.get_index().composition_mobs[mob_id].slot_at(slot_id)
+        except IndexError:
+            log("Cannot find slot %d of nested composition %s" % (slot_id, mob_id), WARNING)
+            return []
+        if profiler.enabled:
+            profiler.count("nested_compositions")
+        if slot.media_kind == "Picture":
+            tracks = self.get_picture_tracks(slot)
+            items = tracks[0].items if tracks else []
+        else:
+            items = self.get_sound_track(slot).items or []
+        self.nested_items[key] = items
+        return items
+
+    # Flattens a clip of a nested composition into copies of the nested
+    # items it covers, trimmed to the clip and moved to its position.
+    # What the clip's own operation groups set applies on top of them.
+    def get_nested_items(self, clip, edit_rate, item):
+        start = clip.start / edit_rate
+        end = start + item.duration
+        items = []
+        for nested in self.get_nested_timeline(str(clip.mob_id), clip.slot_id):
+            nested_end = nested.position + nested.duration
+            if nested_end <= start or nested.position >= end:
+                continue
+            flat = nested.copy()
+            head = max(start - nested.position, 0.0)
+            flat.duration = min(nested_end, end) - nested.position - head
+            flat.position = item.position + nested.position + head - start
+            flat.offset += head * (nested.playbackrate or 1.0)
+            if head > 0:
+                flat.fadein = None
+            if nested_end > end:
+                flat.fadeout = None
+            for name in ["volume_envelope", "panning_envelope"]:
+                if getattr(flat, name) is not None:
+                    setattr(flat, name, getattr(flat, name).trim(head, head + flat.duration))
+                elif getattr(item, name) is not None:
+                    clip_head = flat.position - item.position
+                    setattr(flat, name, getattr(item, name).trim(clip_head, clip_head + flat.duration))
+            if item.volume is not None:
+                flat.volume = item.volume * (1.0 if flat.volume is None else flat.volume)
+            items.append(flat)
+        return items
+
     def get_picture_tracks(self, slot):
         data = []
         edit_rate = self.aafrational_value(slot.edit_rate)
@@ -467,31 +2569,23 @@ class AAFInterface:
             for sequence in slot.segment.slots.value:
                 seq_data = self.parse_sequence(sequence, edit_rate)
                 if seq_data:
-                    data.append({
-                        "name": "",
-                        "items": seq_data
-                    })
+                    data.append(TimelineTrack("", seq_data))
         elif isinstance(slot.segment, aaf2.components.Sequence):
             seq_data = self.parse_sequence(slot.segment, edit_rate)
             if seq_data:
-                data.append({
-                    "name": slot.name,
-                    "items": seq_data
-                })
+                data.append(TimelineTrack(slot.name, seq_data))
 
         return data
 
     def get_sound_track(self, slot):
-        data = {
-            "name": slot.name
-        }
+        data = TimelineTrack(slot.name)
         edit_rate = self.aafrational_value(slot.edit_rate)
         segment = slot.segment
         if isinstance(segment, aaf2.components.OperationGroup):
             # Maybe we should check for segment.operation.name as well?
             for p in segment.parameters:
                 if p.name == "Pan value":
-                    data["panning"] = self.aafrational_value(p.value) * 2 - 1
+                    data.panning = self.aafrational_value(p.value) * 2 - 1
                 if p.name in ["Pan", "Pan Level"]:
                     # Sometimes segment.length is wrong so we have to use
                     # the length of the data segment instead.
@@ -499,14 +2593,11 @@ class AAFInterface:
                     if self.encoder == "DaVinci Resolve":
                         real_length = segment.segments[0].length / edit_rate
                     points = self.get_point_list(p, real_length)
-                    data["panning_envelope"] = [{
-                        "time": point["time"],
-                        "value": point["value"] * -2 + 1
-                        # Reaper can't make up its mind 
-                    } for point in points]
-            data["items"] = self.parse_sequence(segment.segments[0], edit_rate)
+                    # Reaper can't make up its mind 
+                    data.panning_envelope = self.invert_panning(points)
+            data.items = self.parse_sequence(segment.segments[0], edit_rate)
         elif isinstance(segment, aaf2.components.Sequence):
-            data["items"] = self.parse_sequence(segment, edit_rate)
+            data.items = self.parse_sequence(segment, edit_rate)
         return data
 
     def get_markers(self, slot):
@@ -528,65 +2619,306 @@ class AAFInterface:
         return markers
 
     def get_composition_list(self):
-        return [composition.name for composition in self.aaf.content.compositionmobs()]
+        if "composition_list" not in self.cache_entry:
+            self.cache_entry["composition_list"] = [composition.name for composition in self.get_index().compositions]
+        return self.cache_entry["composition_list"]
 
-    def get_composition(self, composition):
-        data = {
-            "tracks": [],
-            "markers": []
-        }
+    def get_composition_id(self, name):
+        composition_list = self.get_composition_list()
+        if name in composition_list:
+            return composition_list.index(name)
+        return None
 
-        for slot in list(self.aaf.content.compositionmobs())[composition].slots:
-            try:
-                if slot.media_kind == "Picture":
-                    picture_tracks = self.get_picture_tracks(slot)
-                    if picture_tracks:
-                        data["tracks"] += picture_tracks
-                elif slot.media_kind in ["Sound", "LegacySound"]:
-                    track_data = self.get_sound_track(slot)
-                    track_data = self.collect_vol_pan_automation(track_data)
-                    data["tracks"].append(track_data)
-                elif slot.media_kind == "DescriptiveMetadata":
-                    data["markers"] += self.get_markers(slot)
-            except Exception:
-                log("Failed parsing slot %s" % slot.name, WARNING)
+    def get_composition_key(self, composition):
+        return json.dumps([composition, self.timeline_version, self.essence_key,
+            volume_envelope_tolerance, panning_envelope_tolerance])
+
+    def get_composition(self, composition):
+        key = self.get_composition_key(composition)
+        if key in self.cache_entry["compositions"]:
+            return self.cache_entry["compositions"][key]
+        data = self.parse_composition(composition).to_dict()
+        if self.cache:
+            self.cache_entry["compositions"][key] = data
         return data
 
+    # Yields ("track", data) and ("marker", data) as soon as each slot is
+    # parsed, so the whole timeline doesn't have to be kept around.
+    # A timeline cached by an earlier import is streamed from the cache.
+    def iter_composition(self, composition):
+        key = self.get_composition_key(composition)
+        if key in self.cache_entry["compositions"]:
+            data = self.cache_entry["compositions"][key]
+            for track in data["tracks"]:
+                yield "track", track
+            for marker in data["markers"]:
+                yield "marker", marker
+            return
+
+        # Not added to the cache, that would keep it all in memory
+        for timeline in self.iter_slots(composition):
+            for track in timeline.tracks:
+                yield "track", track.to_dict()
+            for marker in timeline.markers:
+                yield "marker", marker
+
+    def parse_composition(self, composition):
+        timeline = Timeline()
+        for slot_timeline in self.iter_slots(composition):
+            timeline.extend(slot_timeline)
+        return timeline
+
+    # Yields the parsed slots of a composition in their original order,
+    # parsing them in worker processes if parsing_workers is set.
+    def iter_slots(self, composition):
+        slots = list(self.get_index().compositions[composition].slots)
+        done = 0
+        if parsing_workers > 1 and len(slots) > 1:
+            if have_reaper and not worker_python:
+                log("Set worker_python to parse compositions in parallel inside REAPER.", WARNING)
+            else:
+                try:
+                    for timeline in self.iter_slots_parallel(composition, len(slots)):
+                        done += 1
+                        yield timeline
+                    return
+                except (OSError, concurrent.futures.process.BrokenProcessPool):
+                    log("Could not start parsing workers, parsing serially.", WARNING)
+
+        for slot in slots[done:]:
+            yield self.parse_slot(slot)
+
+    def iter_slots_parallel(self, composition, slot_count):
+        composition_id = str(self.get_index().compositions[composition].mob_id)
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=min(parsing_workers, slot_count),
+            mp_context=get_worker_context(),
+            initializer=parsing_worker_init,
+            initargs=(self.filename, composition_id, self.essence_data, self.essence_segments,
+                self.essence_channels)
+        ) as pool:
+            for timeline, records in pool.map(parsing_worker_run, range(slot_count)):
+                for message, level in records:
+                    log(message, level)
+                yield timeline
+
+    def parse_slot(self, slot):
+        timeline = Timeline()
+        try:
+            if slot.media_kind == "Picture":
+                picture_tracks = self.get_picture_tracks(slot)
+                if picture_tracks:
+                    timeline.tracks += picture_tracks
+            elif slot.media_kind in ["Sound", "LegacySound"]:
+                track_data = self.get_sound_track(slot)
+                track_data = self.collect_vol_pan_automation(track_data)
+                timeline.tracks.append(track_data)
+            elif slot.media_kind == "DescriptiveMetadata":
+                timeline.markers += self.get_markers(slot)
+        except Exception:
+            log("Failed parsing slot %s" % slot.name, WARNING)
+        if self.essence_segments:
+            self.apply_essence_segments(timeline)
+        return timeline
+
     def get_aaf_metadata(self):
+        if "metadata" in self.cache_entry:
+            return self.cache_entry["metadata"]
         try:
             identity = self.aaf.header["IdentificationList"][0]
-            return {
+            metadata = {
                 "company": identity["CompanyName"].value,
                 "product": identity["ProductName"].value,
                 "version": identity["ProductVersionString"].value,
-                "date": identity["Date"].value,
+                "date": str(identity["Date"].value),
                 "platform": identity["Platform"].value
             }
         except Exception:
-            warn("Could not get file identity metadata.", WARNING)
-            return {}
+            log("Could not get file identity metadata.", WARNING)
+            metadata = {}
+        self.cache_entry["metadata"] = metadata
+        return metadata
+
+
+
+def get_worker_context():
+    context = multiprocessing.get_context("spawn")
+    if worker_python:
+        context.set_executable(worker_python)
+    return context
+
+# Each extraction worker process keeps its own handle on the AAF,
+# opened once when the process starts.
+worker_interface = None
+
+def extraction_worker_init(filename):
+    global worker_interface
+    worker_interface = AAFInterface()
+    worker_interface.open(filename)
+
+def extraction_worker_run(job):
+    return worker_interface.extract_job(job)
+
+# Parsing workers get the essence mapping from the main process and
+# return each slot's timeline together with the messages it logged.
+worker_slots = None
+
+def parsing_worker_init(filename, composition_id, essence_data, essence_segments, essence_channels):
+    global worker_interface, worker_slots
+    worker_interface = AAFInterface()
+    worker_interface.open(filename)
+    worker_interface.essence_data = essence_data
+    worker_interface.essence_segments = essence_segments
+    worker_interface.essence_channels = essence_channels
+    composition = worker_interface.aaf.content.mobs.get(aaf2.mobid.MobID(composition_id))
+    worker_slots = list(composition.slots)
+
+def parsing_worker_run(slot_index):
+    global log_records
+    log_records = []
+    try:
+        timeline = worker_interface.parse_slot(worker_slots[slot_index])
+    finally:
+        records, log_records = log_records, None
+    return timeline, records
+
+# Batch workers convert one AAF file each into its own output directory,
+# all of them extracting into one shared media directory.
+batch_settings = None
+
+def batch_worker_init(settings):
+    global batch_settings, extraction_workers, parsing_workers, shared_media, consolidate, media_search_paths
+    global interleave_channels
+    batch_settings = settings
+    extraction_workers = 0
+    parsing_workers = 0
+    shared_media = True
+    consolidate = settings["consolidate"]
+    interleave_channels = settings["interleave_channels"]
+    media_search_paths = settings["media_search_paths"]
+
+def batch_worker_run(job):
+    global log_records
+    results = []
+    log_records = []
+    try:
+        cache = None
+        if batch_settings["use_cache"] and timeline_cache_size > 0:
+            cache = TimelineCache()
+        aaf_interface = AAFInterface()
+        if not aaf_interface.open(job["filename"], cache):
+            return [{
+                "filename": job["filename"],
+                "status": "failed",
+                "error": "Could not open AAF file.",
+                "warnings": [message for message, level in log_records if level >= WARNING]
+            }]
+
+        composition_list = aaf_interface.get_composition_list()
+        if job["composition"] is None:
+            selected = range(len(composition_list))
+        else:
+            selected = [find_composition(aaf_interface, job["composition"])]
+
+        for composition_id in selected:
+            del log_records[:]
+            start = time.time()
+            result = {"filename": job["filename"], "status": "converted"}
+            try:
+                if composition_id is None:
+                    raise ValueError("AAF has no composition %s." % job["composition"])
+                name = composition_list[composition_id]
+                result["composition"] = name
+                media = batch_settings["media"]
+                if not aaf_interface.load_cached_essence(media, composition_id):
+                    aaf_interface.extract_essence(media, None, composition_id)
+                composition = aaf_interface.get_composition(composition_id)
+
+                os.makedirs(job["output"], exist_ok=True)
+                output = os.path.join(job["output"], "%d %s.rpp" % (composition_id, safe_filename(name)))
+                ChunkRenderer(job["output"]).write_project(output, composition)
+                result["output"] = output
+                result["tracks"] = len(composition["tracks"])
+                result["items"] = sum(len(track.get("items", [])) for track in composition["tracks"])
+            except Exception as e:
+                result["status"] = "failed"
+                result["error"] = str(e)
+            result["seconds"] = round(time.time() - start, 3)
+            result["warnings"] = [message for message, level in log_records if level >= WARNING]
+            results.append(result)
+        aaf_interface.save_cache()
+    finally:
+        log_records = None
+    return results
 
 
 
 class UserInteraction:
 
+    # Runs action(progress) on a separate thread while the dialog shows
+    # how many bytes it has written, how fast and how long it will take.
+    # Returns False if it was cancelled.
     @staticmethod
-    def show_progressbar(item_count, action):
+    def show_progressbar(action):
+        progress = ExtractionProgress()
+        state = {"total": 0, "done": 0, "message": "", "result": None, "started": time.time()}
 
-        def update_call(message):
-            if len(message) > 50:
-                message = message[:48] + "..."
+        def run():
+            global log_records
+            log_records = progress
             try:
-                label.config(text=message)
-                progressbar.step()
-                progressbar.update()
-            except Exception:
-                # User closed the window, probably
-                pass
+                action(progress)
+                progress.finish(True)
+            except ExtractionCancelled:
+                progress.append(("Import cancelled.", NOTICE))
+                progress.finish(False)
+            except Exception as e:
+                progress.append(("Extraction failed: %s" % e, ERROR))
+                progress.finish(False)
+            finally:
+                log_records = None
+
+        def get_status():
+            elapsed = time.time() - state["started"]
+            if not state["done"] or elapsed <= 0:
+                return ""
+            speed = state["done"] / elapsed
+            status = "%.1f MB/s" % (speed / (1024 * 1024))
+            if state["total"] > state["done"]:
+                remaining = int((state["total"] - state["done"]) / speed)
+                status += ", %d:%02d left" % (remaining // 60, remaining % 60)
+            return status
+
+        def poll():
+            for event, value in progress.get_events():
+                if event == "total":
+                    state["total"] = value
+                    progressbar.config(maximum=max(value, 1))
+                elif event == "bytes":
+                    state["done"] += value
+                    progressbar.config(value=min(state["done"], state["total"]))
+                elif event == "message":
+                    state["message"] = value if len(value) <= 50 else value[:48] + "..."
+                elif event == "log":
+                    write_log(*value)
+                elif event == "finished":
+                    state["result"] = value
+            if state["result"] is not None:
+                window.quit()
+                return
+            label.config(text=state["message"])
+            status.config(text=get_status())
+            window.after(100, poll)
+
+        def cancel():
+            progress.cancel()
+            button.config(state="disabled")
+            status.config(text="Cancelling...")
 
         window = tkinter.Tk()
         window.title("Importing...")
         window.columnconfigure(0, weight=1)
+        window.protocol("WM_DELETE_WINDOW", cancel)
 
         frame = tkinter.Frame(window, borderwidth=10)
         frame.grid(column=0, row=0, sticky="NWSE")
@@ -595,15 +2927,25 @@ class UserInteraction:
         label = tkinter.Label(frame, text="")
         label.grid(column=0, row=0, sticky="NW")
 
-        progressbar = tkinter.ttk.Progressbar(frame, mode="determinate", maximum=item_count+1, length=500)
+        progressbar = tkinter.ttk.Progressbar(frame, mode="determinate", maximum=1, length=500)
         progressbar.grid(column=0, row=1, sticky="WE")
 
-        action(update_call)
+        status = tkinter.Label(frame, text="")
+        status.grid(column=0, row=2, sticky="NW")
+
+        button = tkinter.Button(frame, text="Cancel", command=cancel)
+        button.grid(column=0, row=3, sticky="E")
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        window.after(100, poll)
+        window.mainloop()
+        thread.join()
         try:
             window.destroy()
-            window.mainloop()
         except Exception:
             pass
+        return state["result"]
 
     @staticmethod
     def get_composition(composition_list):
@@ -617,16 +2959,17 @@ class UserInteraction:
 
     @staticmethod
     def get_composition_cli(composition_list):
-        print("Select composition to parse:")
+        print("Select composition to parse:", file=log_file)
         for i, t in enumerate(composition_list):
-            print("%d. %s" % (i, t))
+            print("%d. %s" % (i, t), file=log_file)
         while True:
             try:
-                composition_id = int(input("> "))
+                print("> ", end="", file=log_file, flush=True)
+                composition_id = int(input())
                 composition_list[composition_id]
                 break
             except Exception:
-                print("Invalid input.")
+                print("Invalid input.", file=log_file)
         return composition_id
 
     @staticmethod
@@ -680,54 +3023,269 @@ class UserInteraction:
                 if result == 6:
                     return i
 
+def safe_filename(name):
+    return "".join("_" if c in '<>:"/\\|?*' or ord(c) < 32 else c for c in name).strip() or "untitled"
+
+def find_composition(aaf_interface, composition):
+    composition_id = aaf_interface.get_composition_id(composition)
+    if composition_id is None and composition.isdigit():
+        composition_id = int(composition)
+    if composition_id is None or composition_id >= len(aaf_interface.get_composition_list()):
+        return None
+    return composition_id
+
+def get_batch_files(paths):
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.lower().endswith(".aaf") and os.path.isfile(os.path.join(path, name)):
+                    filenames.append(os.path.join(path, name))
+        else:
+            filenames.append(path)
+    return filenames
+
+# Converts every given AAF file (or every AAF in the given directories) to
+# REAPER projects in a bounded process pool. Each file gets its own output
+# directory, media goes into one shared directory so essence used by several
+# files is only extracted once, and a summary is written to report.json.
+def batch_import(arguments):
+    filenames = get_batch_files(arguments.filenames)
+    if not filenames:
+        log("No AAF files found.", ERROR)
+        return
+
+    output = os.path.abspath(arguments.output or "converted")
+    media = os.path.abspath(arguments.media or os.path.join(output, "sources"))
+    os.makedirs(media, exist_ok=True)
+    EssenceCache(media).clear_claims()
+
+    jobs = []
+    used = set()
+    for filename in filenames:
+        name = safe_filename(os.path.splitext(os.path.basename(filename))[0])
+        directory = name
+        while directory in used:
+            directory = "%s_%d" % (name, len(used))
+        used.add(directory)
+        jobs.append({
+            "filename": os.path.abspath(filename),
+            "composition": None if arguments.all_compositions else (arguments.composition or "0"),
+            "output": os.path.join(output, directory)
+        })
+
+    settings = {
+        "media": media,
+        "use_cache": not arguments.no_cache,
+        "consolidate": arguments.consolidate,
+        "interleave_channels": arguments.interleave,
+        "media_search_paths": media_search_paths
+    }
+    start = time.time()
+    results = {}
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=min(batch_workers or os.cpu_count() or 1, len(jobs)),
+        mp_context=get_worker_context(),
+        initializer=batch_worker_init,
+        initargs=(settings,)
+    ) as pool:
+        futures = {pool.submit(batch_worker_run, job): i for i, job in enumerate(jobs)}
+        for future in concurrent.futures.as_completed(futures):
+            job = jobs[futures[future]]
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:
+                results[futures[future]] = [{"filename": job["filename"], "status": "failed", "error": str(e)}]
+            for result in results[futures[future]]:
+                for message in result.get("warnings", []):
+                    log(message, WARNING)
+                if result["status"] == "converted":
+                    log("Converted %s (%s) in %.1f seconds" %
+                        (os.path.basename(job["filename"]), result["composition"], result["seconds"]))
+                else:
+                    log("Failed to convert %s: %s" % (os.path.basename(job["filename"]), result["error"]), ERROR)
+
+    report = {
+        "output": output,
+        "media": media,
+        "seconds": round(time.time() - start, 3),
+        "jobs": [result for i in range(len(jobs)) for result in results[i]]
+    }
+    report["converted"] = sum(1 for result in report["jobs"] if result["status"] == "converted")
+    report["failed"] = len(report["jobs"]) - report["converted"]
+    with open(os.path.join(output, "report.json"), "w") as f:
+        json.dump(report, f, indent=2)
+    log("Converted %d of %d compositions, report written to %s" %
+        (report["converted"], len(report["jobs"]), os.path.join(output, "report.json")))
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Convert an AAF file for REAPER.")
+    parser.add_argument("filenames", nargs="*", metavar="filename",
+        help="AAF file to convert, several files or directories convert them all in batch mode")
+    output = parser.add_mutually_exclusive_group()
+    output.add_argument("-o", "--output",
+        help="write a REAPER project (.rpp) instead of printing the composition as JSON, "
+            "in batch mode the directory for the converted projects (default: converted)")
+    output.add_argument("--ndjson", action="store_true",
+        help="print one JSON record per line for each track and marker as soon as it is parsed")
+    parser.add_argument("-c", "--composition",
+        help="name or index of the composition to convert, instead of asking")
+    parser.add_argument("-a", "--all-compositions", action="store_true",
+        help="convert every composition of each file (batch mode)")
+    parser.add_argument("-b", "--batch-workers", type=int, default=batch_workers,
+        help="number of files converted at once in batch mode (default: one per core)")
+    parser.add_argument("-m", "--media",
+        help="directory for extracted media (default: sources, next to the project when writing one)")
+    parser.add_argument("--media-path", action="append", default=[],
+        help="directory to search for linked media that has moved, can be given several times")
+    parser.add_argument("-j", "--workers", type=int, default=extraction_workers,
+        help="number of processes used to extract essence")
+    parser.add_argument("-p", "--parse-workers", type=int, default=parsing_workers,
+        help="number of processes used to parse the composition")
+    parser.add_argument("--consolidate", action="store_true", default=consolidate,
+        help="extract only the used parts of embedded media")
+    parser.add_argument("--interleave", action="store_true", default=interleave_channels,
+        help="extract the mono channels of each clip into one multichannel file")
+    parser.add_argument("--no-cache", action="store_true",
+        help="don't read or write the timeline cache")
+    parser.add_argument("--clear-cache", action="store_true",
+        help="empty the timeline cache first")
+    parser.add_argument("--profile", nargs="?", const="1", default=profile,
+        help="report time, counts and memory use of each phase as JSON, to stderr or to the given file")
+    return parser.parse_args(sys.argv[1:])
+
 def import_aaf():
-    global log_level
+    global log_level, extraction_workers, parsing_workers, batch_workers, consolidate, profile
+    global media_search_paths, interleave_channels, log_file
 
     aaf_interface = AAFInterface()
     reaper_interface = ReaperInterface()
+    arguments = None
+    cache = TimelineCache() if timeline_cache_size > 0 else None
 
     if have_reaper:
         filename = reaper_interface.select_aaf()
         if filename is None: return
         target = reaper_interface.get_project_directory()
     else:
-        if len(sys.argv) < 2:
+        arguments = parse_arguments()
+        profile = arguments.profile
+        if arguments.ndjson:
+            log_file = sys.stderr
+        media_search_paths = media_search_paths + [os.path.abspath(path) for path in arguments.media_path]
+        if arguments.clear_cache:
+            TimelineCache().clear()
+            if not arguments.filenames: return
+        if not arguments.filenames:
             log("No input file provided.", ERROR)
             return
-        filename = sys.argv[1]
-        target = "sources"
+        if (len(arguments.filenames) > 1 or arguments.all_compositions
+                or os.path.isdir(arguments.filenames[0])):
+            if arguments.ndjson:
+                log("Batch mode writes projects, --ndjson is not supported.", ERROR)
+                return
+            log_level = NOTICE
+            batch_workers = arguments.batch_workers
+            if profile and profile != "0":
+                profiler.enable(profile, globals())
+            with profiler.phase("batch"):
+                batch_import(arguments)
+            return
+        if arguments.no_cache:
+            cache = None
+        filename = arguments.filenames[0]
+        target = arguments.media
+        if target is None:
+            target = "sources"
+            if arguments.output:
+                target = os.path.join(os.path.dirname(os.path.abspath(arguments.output)), "sources")
         if not os.path.exists(target):
-            os.mkdir(target)
+            os.makedirs(target)
+        extraction_workers = arguments.workers
+        parsing_workers = arguments.parse_workers
+        consolidate = arguments.consolidate
+        interleave_channels = arguments.interleave
         log_level = NOTICE
 
-    if not aaf_interface.open(filename): return
+    if profile and profile != "0":
+        profiler.enable(profile, globals())
+
+    with profiler.phase("open"):
+        if not aaf_interface.open(filename, cache): return
     log("geting data from %s..." % filename)
-    meta = aaf_interface.get_aaf_metadata()
-    log("AAF created on %s with %s %s version %s using %s" % 
-        (str(meta["date"]), meta["company"], meta["product"], meta["version"], meta["platform"])
-    )
-
-    if have_tk:
-        def action(update):
-            aaf_interface.extract_essence(target, update)
-        count = aaf_interface.get_embedded_essence_count()
-        UserInteraction.show_progressbar(count, action)
-    else:
-        aaf_interface.extract_essence(target, None)
+    with profiler.phase("metadata"):
+        meta = aaf_interface.get_aaf_metadata()
+    if meta:
+        log("AAF created on %s with %s %s version %s using %s" % 
+            (str(meta["date"]), meta["company"], meta["product"], meta["version"], meta["platform"])
+        )
 
     composition_list = aaf_interface.get_composition_list()
     composition_id = 0
-    if len(composition_list) > 1:
+    if arguments and arguments.composition is not None:
+        composition_id = find_composition(aaf_interface, arguments.composition)
+        if composition_id is None:
+            log("AAF has no composition %s." % arguments.composition, ERROR)
+            return
+    elif len(composition_list) > 1:
         composition_id = UserInteraction.get_composition(composition_list)
-    composition = aaf_interface.get_composition(composition_id)
+
+    if aaf_interface.load_cached_essence(target, composition_id):
+        log("Using media extracted earlier.")
+    elif have_tk:
+        def action(progress):
+            aaf_interface.progress = progress
+            try:
+                with profiler.phase("extract_essence"):
+                    aaf_interface.extract_essence(target, progress.message, composition_id)
+            finally:
+                aaf_interface.progress = None
+        if not UserInteraction.show_progressbar(action):
+            return
+    else:
+        with profiler.phase("extract_essence"):
+            aaf_interface.extract_essence(target, None, composition_id)
+
+    if arguments and arguments.ndjson:
+        print(json.dumps({
+            "type": "header",
+            "filename": filename,
+            "composition": composition_list[composition_id],
+            "metadata": meta,
+            "essence": aaf_interface.essence_data
+        }), flush=True)
+        with profiler.phase("parse"):
+            for kind, record in aaf_interface.iter_composition(composition_id):
+                print(json.dumps({"type": kind, kind: record}), flush=True)
+        aaf_interface.save_cache()
+        return
+
+    with profiler.phase("parse"):
+        composition = aaf_interface.get_composition(composition_id)
+    aaf_interface.save_cache()
+    if profiler.enabled:
+        profiler.count("tracks", len(composition["tracks"]))
+        profiler.count("markers", len(composition["markers"]))
+        profiler.count("timeline_items", sum(len(track.get("items", [])) for track in composition["tracks"]))
+        profiler.count("timeline_envelope_points", sum(
+            len(track.get("volume_envelope", [])) + len(track.get("panning_envelope", []))
+            for track in composition["tracks"]))
 
     if have_reaper:
-        reaper_interface.build_project(composition)
+        with profiler.phase("build_project"):
+            reaper_interface.build_project(composition)
+    elif arguments.output:
+        output = os.path.abspath(arguments.output)
+        with profiler.phase("write_project"):
+            ChunkRenderer(os.path.dirname(output)).write_project(output, composition)
+        log("Wrote %s" % output)
     else:
-        print(json.dumps(composition))
+        with profiler.phase("output"):
+            print(json.dumps(composition))
 
 if __name__ == "__main__":
     # sys.exit() or exit() would crash the script, so instead
     # we're using `return` within a main function
     import_aaf()
+    profiler.report()
 
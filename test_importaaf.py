@@ -0,0 +1,407 @@
+import json
+import math
+import os
+import struct
+import threading
+import time
+import types
+import uuid
+
+import aaf2
+import pytest
+
+import benchmark
+import importaaf
+
+
+def get_amplitude(envelope, time):
+    times = list(envelope.times)
+    values = list(envelope.values)
+    for i in range(1, len(times)):
+        if time <= times[i]:
+            return values[i - 1] + (values[i] - values[i - 1]) * (time - times[i - 1]) / (times[i] - times[i - 1])
+    return values[-1]
+
+
+# A fade spaced evenly in dB is a curve in amplitude, which REAPER
+# interpolates linearly between the points that are kept.
+@pytest.mark.parametrize("numpy", [True, False] if importaaf.have_numpy else [False])
+@pytest.mark.parametrize("count", [11, 401])
+def test_simplify_exponential_fade(monkeypatch, numpy, count):
+    monkeypatch.setattr(importaaf, "have_numpy", numpy)
+    interface = importaaf.AAFInterface()
+    # 0 to -40 dB
+    times = [i / (count - 1) for i in range(count)]
+    values = [10 ** (-2 * i / (count - 1)) for i in range(count)]
+    envelope = importaaf.Envelope(times, values)
+
+    simplified = interface.simplify_envelope(envelope, 0.1, interface.amplitude_to_db)
+
+    for time, value in zip(times, values):
+        error = 20 * math.log10(get_amplitude(simplified, time)) - 20 * math.log10(value)
+        assert abs(error) <= 0.1 + 1e-6
+    if count > 100:
+        assert len(simplified) < count / 10
+
+
+@pytest.mark.parametrize("filename, source_type", [
+    ("take.wav", "WAVE"), ("take.MP3", "MP3"), ("take.flac", "FLAC"), ("take.ogg", "VORBIS"), ("take.mov", "VIDEO")])
+def test_chunk_source_type(filename, source_type):
+    assert importaaf.ChunkRenderer().source_type(filename) == source_type
+
+
+# Writes a composition with a clip of every master mob, each master
+# having one slot with embedded 16-bit mono essence. Masters sharing
+# a source are given as (name, index of an earlier master), masters
+# of linked media as (name, path).
+def make_aaf(filename, masters, frames=4800, rate=48000):
+    with aaf2.open(filename, "w") as f:
+        mxf = f.create.ContainerDef(aaf2.auid.AUID(str(uuid.uuid4())), "MXF", "")
+        f.dictionary.register_def(mxf)
+        composition = f.create.CompositionMob("Composition")
+        f.content.mobs.append(composition)
+        sequence = f.create.Sequence(media_kind="sound")
+        source_clips = []
+        for i, master in enumerate(masters):
+            name, shared = master if isinstance(master, tuple) else (master, None)
+            master_mob = f.create.MasterMob(name)
+            f.content.mobs.append(master_mob)
+            if isinstance(shared, str):
+                source_mob = f.create.SourceMob(name + ".PHYS")
+                f.content.mobs.append(source_mob)
+                source_mob.descriptor = f.create.WAVEDescriptor()
+                source_mob.descriptor["Summary"].value = b""
+                source_mob.descriptor["SampleRate"].value = rate
+                source_mob.descriptor.length = frames
+                locator = f.create.NetworkLocator()
+                locator["URLString"].value = "file://" + shared
+                source_mob.descriptor["Locator"].append(locator)
+                source_slot = source_mob.create_timeline_slot(rate)
+                source_slot.segment = f.create.SourceClip(length=frames, media_kind="sound")
+                source_clips.append(source_mob.create_source_clip(source_slot.slot_id, media_kind="sound"))
+            elif shared is None:
+                source_mob = f.create.SourceMob(name + ".PHYS")
+                f.content.mobs.append(source_mob)
+                essence, source_slot = source_mob.create_essence(rate, "sound")
+                descriptor = f.create.PCMDescriptor()
+                source_mob.descriptor = descriptor
+                descriptor["Channels"].value = 1
+                descriptor["BlockAlign"].value = 2
+                descriptor["SampleRate"].value = rate
+                descriptor["AverageBPS"].value = rate * 2
+                descriptor["QuantizationBits"].value = 16
+                descriptor["AudioSamplingRate"].value = rate
+                descriptor["ContainerFormat"].value = mxf
+                descriptor.length = frames
+                source_slot.segment.length = frames
+                essence.open("w").write(struct.pack("<h", 1000 * (i + 1)) * frames)
+                source_clips.append(source_mob.create_source_clip(source_slot.slot_id, media_kind="sound"))
+            else:
+                source_clips.append(source_clips[shared].copy())
+            slot = master_mob.create_timeline_slot(edit_rate=rate)
+            slot.segment = source_clips[i]
+            slot.name = "A1"
+            sequence.components.append(master_mob.create_source_clip(slot.slot_id, length=2, media_kind="sound"))
+        slot = composition.create_timeline_slot(25)
+        slot.segment = sequence
+        slot.name = "Audio 1"
+
+
+# Master mobs are named by the editor and often alike, while their
+# sources aren't: each source gets a file of its own, shared by all
+# masters pointing at it.
+@pytest.mark.parametrize("cache", [True, False])
+def test_extract_same_named_masters(monkeypatch, tmp_path, cache):
+    monkeypatch.setattr(importaaf, "use_essence_cache", cache)
+    monkeypatch.setattr(importaaf, "write_peak_files", False)
+    filename = str(tmp_path / "same.aaf")
+    make_aaf(filename, ["clip", "clip", ("clip", 0)])
+    target = str(tmp_path / "media")
+    os.mkdir(target)
+
+    interface = importaaf.AAFInterface()
+    assert interface.open(filename)
+    interface.extract_essence(target, None, 0)
+
+    files = [slots[1] for slots in interface.essence_data.values()]
+    assert len(files) == 3
+    assert len(set(files)) == 2
+    assert sorted(name for name in os.listdir(target) if name.endswith(".wav")) == sorted(
+        os.path.basename(name) for name in set(files))
+    with open(files[0], "rb") as first, open(files[1], "rb") as second:
+        assert first.read() != second.read()
+
+
+# The timeline cache keeps the essence mapping of an import, which is
+# only good as long as the files it points to are there.
+@pytest.mark.parametrize("remove", ["extracted", "linked"])
+def test_cached_essence_missing_file(monkeypatch, tmp_path, remove):
+    monkeypatch.setattr(importaaf, "write_peak_files", False)
+    linked = str(tmp_path / "linked.wav")
+    with open(linked, "wb") as f:
+        f.write(b"RIFF")
+    filename = str(tmp_path / "linked.aaf")
+    make_aaf(filename, ["clip", ("take", linked), ("offline", str(tmp_path / "offline.wav"))])
+    target = str(tmp_path / "media")
+    os.mkdir(target)
+    cache = importaaf.TimelineCache(str(tmp_path / "cache"))
+
+    def load():
+        interface = importaaf.AAFInterface()
+        assert interface.open(filename, cache)
+        loaded = interface.load_cached_essence(target, 0)
+        if not loaded:
+            interface.extract_essence(target, None, 0)
+        interface.get_composition(0)
+        interface.save_cache()
+        return interface, loaded
+
+    interface, loaded = load()
+    assert not loaded
+    files = sorted(slots[1] for slots in interface.essence_data.values())
+    assert files[0] == linked
+    # Media that was offline all along doesn't count
+    assert load()[1]
+
+    os.remove(linked if remove == "linked" else files[1])
+    interface = importaaf.AAFInterface()
+    interface.open(filename, cache)
+    assert not interface.load_cached_essence(target, 0)
+    assert not interface.cache_entry["essence"]
+    assert not interface.cache_entry["compositions"]
+
+
+# An import waiting for essence another one claimed takes over once the
+# claim stops being touched, but not while its holder is extracting.
+def test_essence_cache_wait(monkeypatch, tmp_path):
+    monkeypatch.setattr(importaaf.EssenceCache, "lock_timeout", 0.3)
+    holder = importaaf.EssenceCache(str(tmp_path))
+    waiter = importaaf.EssenceCache(str(tmp_path))
+    assert holder.claim("key")
+    assert not waiter.claim("key")
+
+    result = []
+    thread = threading.Thread(target=lambda: result.append(waiter.wait("key")))
+    thread.start()
+    thread.join(1)
+    assert thread.is_alive()
+    holder.release_claims()
+    thread.join(1)
+    assert result == [None]
+
+    # The holder died without releasing it
+    assert holder.claim("key")
+    holder.heartbeat_stop.set()
+    start = time.time()
+    assert waiter.wait("key") is None
+    assert time.time() - start < 1
+    assert waiter.claim("key")
+    waiter.release_claims()
+
+
+# Peaks are computed on the fly from essence arriving in chunks that
+# don't line up with frames or peaks.
+@pytest.mark.skipif(not importaaf.have_numpy, reason="needs NumPy")
+def test_peak_file(tmp_path):
+    numpy = importaaf.numpy
+    channels = 2
+    frames = 120 * 400 * 2 + 77
+    samples = numpy.random.default_rng(1).integers(-2 ** 15, 2 ** 15, (frames, channels), dtype=numpy.int16)
+    # 24-bit, the low byte is dropped for the peaks
+    data = numpy.zeros((frames, channels, 3), dtype=numpy.uint8)
+    data[:, :, 1:] = samples.view(numpy.uint8).reshape(frames, channels, 2)
+    data = data.tobytes()
+    source = str(tmp_path / "source.wav")
+    with open(source, "wb") as f:
+        f.write(data)
+
+    builder = importaaf.PeakBuilder(24, 48000, channels)
+    for start in range(0, len(data), 10007):
+        builder.add(data[start:start + 10007])
+    builder.write(source + ".reapeaks", source)
+    builder.close()
+
+    with open(source + ".reapeaks", "rb") as f:
+        peak_data = f.read()
+    assert peak_data[:4] == b"RPKN"
+    _, count = struct.unpack("<BB", peak_data[4:6])
+    assert count == 3
+    offset = 18 + 8 * count
+    for i, factor in enumerate([1, 40, 400]):
+        division, length = struct.unpack("<II", peak_data[18 + 8 * i:26 + 8 * i])
+        assert division == 120 * factor
+        starts = numpy.arange(0, frames, division)
+        expected = numpy.stack([numpy.maximum.reduceat(samples, starts), numpy.minimum.reduceat(samples, starts)], axis=2)
+        assert length == len(expected)
+        peaks = numpy.frombuffer(peak_data, "<i2", length * channels * 2, offset)
+        assert (peaks.reshape(length, channels, 2) == expected).all()
+        offset += length * channels * 4
+    assert offset == len(peak_data)
+
+
+def make_nested_item(position, duration, offset=0.0):
+    item = importaaf.TimelineItem("nested.wav", offset, position, duration)
+    item.fadein = 0.5
+    item.fadeout = 0.5
+    return item
+
+
+# A clip from 2 s to 6 s of a nested composition, placed at 10 s
+def get_nested_items(interface, nested, item=None):
+    interface.nested_items[("nested", 1)] = nested
+    clip = types.SimpleNamespace(mob_id="nested", slot_id=1, start=50)
+    if item is None:
+        item = importaaf.TimelineItem(None, 0.0, 10.0, 4.0)
+    return interface.get_nested_items(clip, 25, item)
+
+
+def test_nested_items_head_trim():
+    interface = importaaf.AAFInterface()
+    nested = make_nested_item(1.0, 3.0, 5.0)
+    nested.playbackrate = 2.0
+    [item] = get_nested_items(interface, [nested])
+    assert (item.position, item.duration) == (10.0, 2.0)
+    # A second of the nested item at twice the speed is cut off
+    assert item.offset == 7.0
+    assert item.fadein is None
+    assert item.fadeout == 0.5
+    assert (nested.position, nested.offset, nested.fadein) == (1.0, 5.0, 0.5)
+
+
+def test_nested_items_tail_trim():
+    interface = importaaf.AAFInterface()
+    items = get_nested_items(interface, [make_nested_item(0.0, 1.0), make_nested_item(3.0, 5.0), make_nested_item(6.0, 1.0)])
+    assert len(items) == 1
+    assert (items[0].position, items[0].duration, items[0].offset) == (11.0, 3.0, 0.0)
+    assert items[0].fadein == 0.5
+    assert items[0].fadeout is None
+
+
+def test_nested_items_clip_envelope():
+    interface = importaaf.AAFInterface()
+    clip_item = importaaf.TimelineItem(None, 0.0, 10.0, 4.0)
+    clip_item.volume_envelope = importaaf.Envelope([0.0, 4.0], [0.0, 1.0])
+    clip_item.volume = 0.5
+    enveloped = make_nested_item(3.0, 2.0)
+    enveloped.volume_envelope = importaaf.Envelope([0.0, 2.0], [1.0, 0.0])
+    enveloped.volume = 0.5
+    plain, enveloped = get_nested_items(interface, [make_nested_item(1.0, 2.0), enveloped], clip_item)
+
+    # The clip's envelope over the part of the clip each item covers
+    assert list(plain.volume_envelope.times) == [0.0, 1.0]
+    assert list(plain.volume_envelope.values) == [0.0, 0.25]
+    assert plain.volume == 0.5
+    # Items keep their own envelopes
+    assert list(enveloped.volume_envelope.times) == [0.0, 2.0]
+    assert list(enveloped.volume_envelope.values) == [1.0, 0.0]
+    assert enveloped.volume == 0.25
+    assert enveloped.panning_envelope is None
+
+
+def test_nested_self_reference(tmp_path):
+    filename = str(tmp_path / "self.aaf")
+    with aaf2.open(filename, "w") as f:
+        composition = f.create.CompositionMob("Loop")
+        f.content.mobs.append(composition)
+        sequence = f.create.Sequence(media_kind="sound")
+        slot = composition.create_timeline_slot(25)
+        slot.segment = sequence
+        sequence.components.append(composition.create_source_clip(slot.slot_id, length=25, media_kind="sound"))
+
+    interface = importaaf.AAFInterface()
+    assert interface.open(filename)
+    mob_id = str(interface.get_index().compositions[0].mob_id)
+    assert interface.get_nested_timeline(mob_id, 1) == []
+
+
+@pytest.fixture
+def reaper(monkeypatch):
+    mock = benchmark.MockReaper()
+    for name in dir(mock):
+        if name.startswith("RPR_"):
+            monkeypatch.setattr(importaaf, name, getattr(mock, name), raising=False)
+    monkeypatch.setattr(importaaf, "reconform", True)
+    monkeypatch.setattr(importaaf, "log_records", [])
+    return mock
+
+
+def make_item(mob_id, position, duration=2.0, offset=0.0):
+    return {"mob_id": mob_id, "slot_id": 1, "source": mob_id + ".wav",
+        "offset": offset, "position": position, "duration": duration}
+
+
+def make_project(items, volume_envelope=None):
+    track = {"name": "A1", "items": items}
+    if volume_envelope is not None:
+        track["volume_envelope"] = [{"time": time, "value": value} for time, value in volume_envelope]
+    return {"tracks": [track], "markers": []}
+
+
+def get_track_items(reaper):
+    [track] = reaper.tracks
+    return {json.loads(reaper.item_data[item])["mob_id"]: item for item in reaper.items[track]}
+
+
+def get_volume_points(reaper):
+    [track] = reaper.tracks
+    return [point[:2] for point in reaper.envelope_points[reaper.envelopes[(track, "Volume")]]]
+
+
+@pytest.mark.parametrize("chunks", [True, False])
+def test_reconform_items(monkeypatch, reaper, chunks):
+    monkeypatch.setattr(importaaf, "build_with_chunks", chunks)
+    interface = importaaf.ReaperInterface()
+    interface.build_project(make_project(
+        [make_item("kept", 0.0), make_item("moved", 2.0), make_item("trimmed", 4.0), make_item("deleted", 6.0)]))
+    before = get_track_items(reaper)
+
+    importaaf.log_records.clear()
+    interface.build_project(make_project(
+        [make_item("kept", 0.0), make_item("moved", 3.0), make_item("trimmed", 5.5, 1.0, 1.5), make_item("added", 8.0)]))
+
+    assert importaaf.log_records == [("Re-conformed items: 1 unchanged, 2 changed, 1 added, 1 deleted", importaaf.NOTICE)]
+    after = get_track_items(reaper)
+    assert sorted(after) == ["added", "kept", "moved", "trimmed"]
+    for mob_id in ["kept", "moved", "trimmed"]:
+        assert after[mob_id] == before[mob_id]
+    assert json.loads(reaper.item_data[after["trimmed"]])["offset"] == 1.5
+    assert len(reaper.tracks) == 1
+
+
+@pytest.mark.parametrize("chunks", [True, False])
+def test_reconform_track_envelopes(monkeypatch, reaper, chunks):
+    monkeypatch.setattr(importaaf, "build_with_chunks", chunks)
+    interface = importaaf.ReaperInterface()
+    items = [make_item("clip", 0.0)]
+    interface.build_project(make_project(items))
+
+    # Added in the AAF
+    interface.build_project(make_project(items, [(0.0, 1.0), (1.0, 0.5)]))
+    assert get_volume_points(reaper) == [(0.0, 1.0), (1.0, 0.5)]
+
+    # Unchanged in the AAF, edited in REAPER
+    [track] = reaper.tracks
+    envelope = reaper.envelopes[(track, "Volume")]
+    reaper.envelope_points[envelope].append((2.0, 0.25, 0))
+    interface.build_project(make_project(items, [(0.0, 1.0), (1.0, 0.5)]))
+    assert get_volume_points(reaper) == [(0.0, 1.0), (1.0, 0.5), (2.0, 0.25)]
+
+    # Changed in both
+    importaaf.log_records.clear()
+    interface.build_project(make_project(items, [(0.0, 0.5)]))
+    assert get_volume_points(reaper) == [(0.0, 1.0), (1.0, 0.5), (2.0, 0.25)]
+    assert ("Envelopes changed in the AAF but edited in REAPER were kept: A1 (Volume)", importaaf.WARNING) \
+        in importaaf.log_records
+
+    # Changed in the AAF only
+    reaper.envelope_points[envelope].pop()
+    interface.build_project(make_project(items, [(0.0, 0.5), (3.0, 1.0)]))
+    assert get_volume_points(reaper) == [(0.0, 0.5), (3.0, 1.0)]
+    importaaf.log_records.clear()
+    interface.build_project(make_project(items, [(0.0, 0.5), (3.0, 1.0)]))
+    assert get_volume_points(reaper) == [(0.0, 0.5), (3.0, 1.0)]
+    assert [level for _, level in importaaf.log_records] == [importaaf.NOTICE]
+
+    # Removed in the AAF
+    interface.build_project(make_project(items))
+    assert get_volume_points(reaper) == []